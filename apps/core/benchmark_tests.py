@@ -0,0 +1,129 @@
+""" Benchmarks of map generation, autocomplete and data import
+
+Run with ``pytest --benchmark apps/core/benchmark_tests.py``; timings are
+written to ``--benchmark-json`` (``benchmark.json`` by default) so they can be
+compared between commits.
+"""
+import random
+
+from django.urls import reverse
+
+import pytest
+
+from apps.core import mapcache
+from apps.core.factories import NationFactory, UnitFactory
+from apps.core.serializers import GenerateMapSerializer, get_leadership
+from apps.domdata.catalog import get_catalog, invalidate_catalog
+from apps.domdata.models import Nation, Unit
+from apps.domdata.parser import import_data
+
+pytestmark = [pytest.mark.benchmark, pytest.mark.django_db()]
+
+NATIONS_PER_MOD = 100
+UNITS_PER_MOD = 10000
+MODS = (Unit.VANILLA, Unit.DE, Unit.DEBUG)
+ARMY_COMMANDERS, ARMY_STACKS = 10, 100
+
+
+@pytest.fixture
+def large_catalog():
+    """Tens of thousands of units in several mods, each recruited by 1 to 3 nations"""
+    rng = random.Random(0)
+    nations, units = [], []
+    for mod in MODS:
+        nations += NationFactory.build_batch(NATIONS_PER_MOD, modded=mod)
+        units += UnitFactory.build_batch(UNITS_PER_MOD, modded=mod)
+    Nation.objects.bulk_create(nations, batch_size=500)
+    Unit.objects.bulk_create(units, batch_size=500)
+    nation_pks = list(Nation.objects.values_list("pk", flat=True))
+    through = Unit.nations.through
+    through.objects.bulk_create(
+        (
+            through(unit_id=unit_pk, nation_id=nation_pk)
+            for unit_pk in Unit.objects.values_list("pk", flat=True)
+            for nation_pk in rng.sample(nation_pks, rng.randint(1, 3))
+        ),
+        batch_size=500,
+    )
+    invalidate_catalog()
+    return get_catalog()
+
+
+@pytest.fixture
+def large_army(large_catalog):
+    """A generate-map payload of two nations with big armies from their rosters"""
+    rng = random.Random(0)
+    nations = [
+        x for x in large_catalog.get_nations((Unit.VANILLA,)) if x.era == Nation.EARLY
+    ][:2]
+    data = {"commanders": [], "units": [], "water_nation_1": "", "water_nation_2": ""}
+    for field, nation in zip(("land_nation_1", "land_nation_2"), nations):
+        name = "({}) {}".format(nation.get_era_display(), nation.name)
+        data[field] = name
+        commanders, troops = large_catalog.get_roster(nation.dominion_id, MODS)
+        leadership = 0
+        for unit in rng.choices(commanders, k=ARMY_COMMANDERS):
+            data["commanders"].append(
+                {"dominion_id": str(unit.dominion_id), "for_nation": name}
+            )
+            leadership += get_leadership(unit.dominion_id)
+        # As many units as the commanders lead, the stacks all fit.
+        for index, unit in enumerate(rng.choices(troops, k=ARMY_STACKS)):
+            quantity = leadership // ARMY_STACKS + (index < leadership % ARMY_STACKS)
+            if not quantity:
+                continue
+            data["units"].append(
+                {
+                    "dominion_id": str(unit.dominion_id),
+                    "for_nation": name,
+                    "quantity": str(quantity),
+                }
+            )
+    return data
+
+
+def test_generate_map_end_to_end(large_army, client, settings, benchmark):
+    url = reverse("v0:generate_map")
+    settings.MAP_CACHE_MAX_BYTES = 0
+
+    def generate(output):
+        response = client.post(
+            url + "?output=" + output, large_army, content_type="application/json"
+        )
+        assert response.status_code == 200
+        return b"".join(response.streaming_content if output == "file" else [])
+
+    benchmark("file", generate, "file")
+    settings.MAP_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    benchmark("json uncached", generate, "json", setup=mapcache.local_cache.clear)
+    benchmark("json cached", generate, "json", rounds=20)
+
+
+def test_generate_map_stages(large_army, benchmark):
+    def validate():
+        serializer = GenerateMapSerializer(data=large_army)
+        assert serializer.is_valid(), serializer.errors
+        return serializer
+
+    serializer = benchmark("validate", validate)
+    data = benchmark("process_data", serializer.process_data, serializer.validated_data)
+    text = benchmark("data_into_map", serializer.data_into_map, data)
+    benchmark("render", lambda: b"".join(serializer.stream(text)))
+    benchmark("summary", serializer.get_summary, data)
+
+
+@pytest.mark.parametrize(
+    "query", ["", "a", "jo", "smith", "john smith", "jonh&fuzzy=1", "zzzzzz&fuzzy=1"]
+)
+def test_autocomplete(large_catalog, client, benchmark, query):
+    for view in ("autocomplete_units_view", "autocomplete_nations_view"):
+        url = reverse("v0:" + view) + "?modded=1,2,3&search=" + query
+        # The first request builds the search index of the mod set.
+        benchmark(view + " first", client.get, url, rounds=1)
+        benchmark(view, client.get, url, rounds=20)
+
+
+def test_import_data(benchmark):
+    benchmark("full", import_data, rounds=1)
+    benchmark("forced without changes", import_data, force=True, rounds=3)
+    benchmark("unchanged", import_data, rounds=20)
@@ -6,6 +6,8 @@ import factory.fuzzy
 from apps.domdata.models import Nation, Unit
 
 ERA_CHOICES = [x[0] for x in Nation.ERA_CHOICES]
+# Generated dominion_ids are unique and above the ids of the game and the mods.
+FIRST_DOMINION_ID = 100000
 
 
 class NationFactory(factory.django.DjangoModelFactory):
@@ -15,7 +17,7 @@ class NationFactory(factory.django.DjangoModelFactory):
 
     name = factory.Faker("company")
     era = factory.fuzzy.FuzzyChoice(ERA_CHOICES)
-    dominion_id = factory.Faker("pyint")
+    dominion_id = factory.Sequence(lambda n: FIRST_DOMINION_ID + n)
 
 
 class UnitFactory(factory.django.DjangoModelFactory):
@@ -24,7 +26,7 @@ class UnitFactory(factory.django.DjangoModelFactory):
         django_get_or_create = ("dominion_id",)
 
     name = factory.Faker("name")
-    dominion_id = factory.Faker("pyint")
+    dominion_id = factory.Sequence(lambda n: FIRST_DOMINION_ID + n)
     commander = factory.fuzzy.FuzzyChoice([True, False])
 
     @factory.post_generation
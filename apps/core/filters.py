@@ -0,0 +1,74 @@
+from rest_framework import filters
+from rest_framework.exceptions import ValidationError
+
+from apps.domdata.stats import OPERATORS, get_stat_table
+
+
+class CatalogSearchFilter(filters.SearchFilter):
+    """``SearchFilter`` answered by the view's catalog search index.
+
+    Instead of ``icontains`` lookups over a queryset, the ``search`` terms go to
+    ``view.get_search_index()``, which ranks every match. Pagination then only
+    ranks the entries up to the end of the requested page, and counts them all.
+    ``?fuzzy=1`` asks for the typo tolerant index.
+    """
+
+    fuzzy_param = "fuzzy"
+
+    def is_fuzzy(self, request):
+        return request.query_params.get(self.fuzzy_param, "") in ("1", "true")
+
+    def filter_queryset(self, request, queryset, view):
+        search_terms = self.get_search_terms(request)
+        if not search_terms:
+            return queryset
+        index = view.get_search_index(fuzzy=self.is_fuzzy(request))
+        return index.rank(" ".join(search_terms))
+
+
+class StatFilter(filters.BaseFilterBackend):
+    """Filter and order units by their ``BaseU.csv`` stats.
+
+    ``?<stat>=<n>`` and ``?<stat>__gt|gte|lt|lte=<n>`` keep the units whose
+    stat compares to ``n``, ``?ordering=<stat>`` or ``-<stat>`` sorts them.
+    Other parameters are left to the other backends. Units without stats, new
+    units of mods, are left out as soon as a stat is filtered or ordered by.
+    """
+
+    ordering_param = "ordering"
+
+    def get_filters(self, request, table):
+        found = []
+        for param, value in request.query_params.items():
+            name, _, operator = param.partition("__")
+            if name not in table.columns:
+                continue
+            operator = operator or "exact"
+            if operator not in OPERATORS:
+                raise ValidationError({param: ["Unknown lookup {}".format(operator)]})
+            try:
+                found.append((name, operator, int(value)))
+            except ValueError:
+                raise ValidationError({param: ["A valid integer is required."]})
+        return found
+
+    def get_ordering(self, request, table):
+        ordering = request.query_params.get(self.ordering_param)
+        if ordering and ordering.lstrip("-") not in table.columns:
+            raise ValidationError(
+                {self.ordering_param: ["There is no such stat as {}".format(ordering)]}
+            )
+        return ordering
+
+    def filter_queryset(self, request, queryset, view):
+        table = get_stat_table()
+        stat_filters = self.get_filters(request, table)
+        ordering = self.get_ordering(request, table)
+        if not stat_filters and not ordering:
+            return queryset
+        entries = {x.dominion_id: x for x in queryset}
+        found = table.query(stat_filters, ordering, entries)
+        if ordering:
+            return [entries[x] for x in found]
+        found = set(found)
+        return [x for x in queryset if x.dominion_id in found]
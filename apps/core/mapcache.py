@@ -0,0 +1,105 @@
+"""Content-addressed cache of rendered maps.
+
+Maps are keyed by a hash of the canonicalized generate request and kept in a
+process-local LRU bounded by the total size of the stored maps. When
+``MAP_CACHE_ALIAS`` names one of the ``CACHES``, that backend is used as a
+shared second level, so workers can reuse each other's renders.
+
+Keys also cover the catalog version, the fingerprint of the map template and
+``RENDER_VERSION``, so a re-import or a deploy changing maps never serves, or
+answers 304 for, a map rendered before.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Bump whenever the same request and data render to a different map.
+RENDER_VERSION = 1
+
+
+def canonical_key(payload, version=""):
+    """Return the sha256 hex digest of a JSON-serializable payload."""
+    encoded = json.dumps(
+        [version, payload], sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class MapCache:
+    """Thread-safe LRU of ``bytes`` values with size-based eviction."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+local_cache = MapCache(settings.MAP_CACHE_MAX_BYTES)
+
+
+def _shared_cache():
+    alias = settings.MAP_CACHE_ALIAS
+    return caches[alias] if alias else None
+
+
+def get_map(key):
+    value = local_cache.get(key)
+    if value is None:
+        shared = _shared_cache()
+        if shared is not None:
+            value = shared.get("map:{}".format(key))
+            if value is not None:
+                local_cache.set(key, value)
+    return value
+
+
+def set_map(key, value):
+    local_cache.set(key, value)
+    shared = _shared_cache()
+    if shared is not None:
+        shared.set("map:{}".format(key), value, settings.MAP_CACHE_TIMEOUT)
+
+
+def stream_into_cache(key, chunks):
+    """Yield ``chunks``, then cache them joined once the last one was sent.
+
+    A stream closed early, like by a client going away, is not cached.
+    """
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    set_map(key, b"".join(parts))
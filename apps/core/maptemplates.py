@@ -0,0 +1,137 @@
+"""Process-resident map templates.
+
+Every map in ``apps/core/data`` is read and split once per worker into static
+chunks and ``$name`` slots, so rendering a map is a plain join instead of file
+I/O plus a regex pass over ~4,900 lines.
+
+The unrendered map is also served as a long-cached base map, see
+``fingerprint``: clients asking for the scenario only fill its slots themselves.
+
+Static chunks are gzip compressed once as well. A gzip stream may consist of
+several members, so a compressed map is the precompressed chunks with only the
+slot values compressed per request in between.
+"""
+import hashlib
+import os
+import threading
+import zlib
+from string import Template
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+MAP_NAMES = ("Arena", "Arena_with_cave")
+# Static chunks are compressed once per worker, slot values on every request.
+STATIC_GZIP_LEVEL = 9
+DYNAMIC_GZIP_LEVEL = 6
+
+
+def gzip_member(data, level=DYNAMIC_GZIP_LEVEL):
+    """Return ``data`` as one gzip member, with a zero timestamp."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class MapTemplate:
+    """A map file compiled into alternating static chunks and named slots.
+
+    ``chunks`` always has one element more than ``slots``: the rendered map is
+    ``chunks[0] + value(slots[0]) + chunks[1] + ... + chunks[-1]``. The syntax
+    is the one of :class:`string.Template`, including ``${name}`` and ``$$``.
+
+    ``source`` is the encoded template and ``fingerprint`` a hash of it, which
+    changes whenever the map file does. ``gzip_chunks`` and ``gzip_source`` are
+    their gzip compressed counterparts.
+    """
+
+    def __init__(self, name, text):
+        self.name = name
+        self.chunks, self.slots = self.compile(text)
+        self.encoded_chunks = tuple(chunk.encode() for chunk in self.chunks)
+        self.source = text.encode()
+        self.fingerprint = hashlib.sha256(self.source).hexdigest()[:16]
+        self.gzip_chunks = tuple(
+            gzip_member(chunk, STATIC_GZIP_LEVEL) if chunk else b""
+            for chunk in self.encoded_chunks
+        )
+        self.gzip_source = gzip_member(self.source, STATIC_GZIP_LEVEL)
+
+    @staticmethod
+    def compile(text):
+        chunks, slots, current, position = [], [], [], 0
+        for match in Template.pattern.finditer(text):
+            start, end = match.span()
+            current.append(text[position:start])
+            position = end
+            if match.group("escaped") is not None:
+                current.append(Template.delimiter)
+                continue
+            name = match.group("named") or match.group("braced")
+            if name is None:
+                raise ValueError(
+                    "Invalid placeholder in map template at index {}".format(
+                        match.start("invalid")
+                    )
+                )
+            chunks.append("".join(current))
+            slots.append(name)
+            current = []
+        current.append(text[position:])
+        chunks.append("".join(current))
+        return tuple(chunks), tuple(slots)
+
+    def values(self, context):
+        """Return slot values in order, raising ``KeyError`` like ``substitute``."""
+        return [str(context[slot]) for slot in self.slots]
+
+    def render(self, context):
+        values = self.values(context)
+        parts = [self.chunks[0]]
+        for value, chunk in zip(values, self.chunks[1:]):
+            parts.append(value)
+            parts.append(chunk)
+        return "".join(parts)
+
+    def iter_encoded(self, context):
+        """Iterate the rendered map as UTF-8 bytes, reusing the pre-encoded chunks.
+
+        Slot values are resolved eagerly so a missing key fails before anything
+        is streamed; the static chunks themselves are shared, never copied.
+        """
+        parts = [self.encoded_chunks[0]]
+        for value, chunk in zip(self.values(context), self.encoded_chunks[1:]):
+            parts.append(value.encode())
+            parts.append(chunk)
+        return iter(parts)
+
+    def iter_gzip(self, context):
+        """Iterate the rendered map as gzip members, see :meth:`iter_encoded`.
+
+        Empty chunks and values are left out, their members would only add
+        headers.
+        """
+        parts = [self.gzip_chunks[0]]
+        for value, chunk in zip(self.values(context), self.gzip_chunks[1:]):
+            if value:
+                parts.append(gzip_member(value.encode()))
+            parts.append(chunk)
+        return iter(part for part in parts if part)
+
+
+_templates = {}
+_lock = threading.Lock()
+
+
+def get_map_template(name):
+    template = _templates.get(name)
+    if template is None:
+        with _lock:
+            template = _templates.get(name)
+            if template is None:
+                path = os.path.join(DATA_DIR, "{}.map".format(name))
+                with open(path, "r") as mapfile:
+                    template = MapTemplate(name, mapfile.read())
+                _templates[name] = template
+    return template
+
+
+def load_map_templates():
+    return [get_map_template(name) for name in MAP_NAMES]
@@ -0,0 +1,130 @@
+"""Always-on timing of request stages.
+
+Views wrap their expensive steps in :func:`timed`. ``ServerTimingMiddleware``
+collects the durations of a request, sends them in a ``Server-Timing`` header
+and adds them, with the total, to in-process histograms labelled by endpoint
+and ``?modded`` mod set. :func:`render_metrics` exposes the histograms in the
+Prometheus text format.
+
+Histograms live in the worker process: every worker reports its own requests
+since it started.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from apps.domdata.catalog import parse_mods
+
+METRIC_NAME = "dom5_request_stage_seconds"
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TOTAL = "total"
+
+_request = threading.local()
+
+
+class Histogram:
+    """Bucketed counts, sum and count of observations per label set."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    def samples(self):
+        """Yield ``(suffix, labels, value)`` with cumulative bucket counts."""
+        with self._lock:
+            series = sorted((x, list(y[0]), y[1]) for x, y in self.series.items())
+        for labels, counts, total in series:
+            cumulative = 0
+            bounds = [str(x) for x in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield "_bucket", labels + (("le", bound),), cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+    def clear(self):
+        with self._lock:
+            self.series.clear()
+
+
+stage_histogram = Histogram()
+
+
+@contextmanager
+def timed(stage):
+    """Time a stage of the current request, a no-op outside of requests."""
+    timings = getattr(_request, "timings", None)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((stage, time.perf_counter() - start))
+
+
+def get_mods_label(request):
+    """Return the mod set of a request as ``1-2``."""
+    return "-".join(map(str, parse_mods(request.GET.get("modded"))))
+
+
+def server_timing(timings):
+    return ", ".join("{};dur={:.2f}".format(x, y * 1000) for x, y in timings)
+
+
+class ServerTimingMiddleware:
+    """Time named API endpoints, see the module documentation.
+
+    Requests which do not resolve to a named URL, like the frontend, are not
+    recorded. Stages of streamed content run after the response is returned
+    and are not part of the header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _request.timings = timings = []
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request.timings = None
+        timings.append((TOTAL, time.perf_counter() - start))
+        match = request.resolver_match
+        if match is None or not match.url_name:
+            return response
+        labels = (("endpoint", match.url_name), ("mods", get_mods_label(request)))
+        for stage, seconds in timings:
+            stage_histogram.observe(labels + (("stage", stage),), seconds)
+        response["Server-Timing"] = server_timing(timings)
+        return response
+
+
+def format_labels(labels):
+    return ",".join('{}="{}"'.format(x, y) for x, y in labels)
+
+
+def render_metrics():
+    lines = [
+        "# HELP {} Duration of API request stages.".format(METRIC_NAME),
+        "# TYPE {} histogram".format(METRIC_NAME),
+    ]
+    for suffix, labels, value in stage_histogram.samples():
+        lines.append(
+            "{}{}{{{}}} {}".format(METRIC_NAME, suffix, format_labels(labels), value)
+        )
+    return "\n".join(lines) + "\n"
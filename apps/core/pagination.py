@@ -0,0 +1,41 @@
+from django.conf import settings
+
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+
+
+class CatalogPagination(LimitOffsetPagination):
+    """Limit/offset pages capped at ``AUTOCOMPLETE_MAX_LIMIT`` entries.
+
+    Every response is paginated, even without ``?limit``, searches by
+    ``AUTOCOMPLETE_SEARCH_LIMIT`` entries by default. The body stays a plain
+    list, the total count and the neighbouring pages are sent in the
+    ``X-Total-Count`` and ``Link`` headers.
+    """
+
+    search_param = "search"
+
+    def __init__(self):
+        self.default_limit = self.max_limit = settings.AUTOCOMPLETE_MAX_LIMIT
+
+    def get_limit(self, request):
+        if (
+            self.limit_query_param not in request.query_params
+            and request.query_params.get(self.search_param)
+        ):
+            return min(settings.AUTOCOMPLETE_SEARCH_LIMIT, self.max_limit)
+        return super().get_limit(request)
+
+    def get_paginated_response(self, data):
+        links = [
+            '<{}>; rel="{}"'.format(url, rel)
+            for url, rel in (
+                (self.get_next_link(), "next"),
+                (self.get_previous_link(), "prev"),
+            )
+            if url
+        ]
+        headers = {"X-Total-Count": str(self.count)}
+        if links:
+            headers["Link"] = ", ".join(links)
+        return Response(data, headers=headers)
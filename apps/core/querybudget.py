@@ -0,0 +1,121 @@
+"""Per-view budgets of database queries.
+
+Views declare how many queries a request may take with :func:`query_budget`.
+:func:`check_query_budget` counts the queries of a block with
+``connection.execute_wrapper`` and raises :class:`QueryBudgetExceeded` past
+the budget, for tests. With ``QUERY_BUDGETS`` set, ``QueryBudgetMiddleware``
+checks every request to a budgeted view and logs a warning, or raises when
+``QUERY_BUDGET_RAISE`` is also set.
+
+Reports group queries by fingerprint, the SQL with literals and ``IN`` lists
+collapsed, so an N+1 pattern shows as one statement repeated N times.
+"""
+import logging
+import re
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LISTS = re.compile(r"\bIN \((?:\s*(?:%s|\?)\s*,?)+\)", re.IGNORECASE)
+SPACES = re.compile(r"\s+")
+# Transaction control, like the savepoints of nested atomic blocks, is not counted.
+TRANSACTION_CONTROL = re.compile(
+    r"\s*(?:SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT|SET TRANSACTION)\b",
+    re.IGNORECASE,
+)
+# Fingerprints listed in a report, most repeated first.
+REPORT_LENGTH = 10
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def fingerprint(sql):
+    """Return ``sql`` with literals as ``?`` and ``IN`` lists as ``IN (...)``."""
+    sql = LITERALS.sub("?", sql)
+    sql = IN_LISTS.sub("IN (...)", sql.replace("?", "%s"))
+    return SPACES.sub(" ", sql).strip()
+
+
+class QueryCounter:
+    """Execute wrapper counting queries by fingerprint."""
+
+    def __init__(self):
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        if not TRANSACTION_CONTROL.match(sql):
+            self.fingerprints[fingerprint(sql)] += 1
+        return execute(sql, params, many, context)
+
+    @property
+    def count(self):
+        return sum(self.fingerprints.values())
+
+    def report(self, name, budget):
+        lines = ["{} ran {} queries, budget {}".format(name, self.count, budget)]
+        for sql, repeats in self.fingerprints.most_common(REPORT_LENGTH):
+            lines.append("{:>5}x {}".format(repeats, sql))
+        return "\n".join(lines)
+
+
+def query_budget(budget):
+    """Declare the number of queries a view may run per request.
+
+    Works on function views and on view classes, as a class decorator.
+    """
+
+    def decorator(view):
+        view.query_budget = budget
+        return view
+
+    return decorator
+
+
+def get_query_budget(view):
+    """Return the budget of a view function or class, ``None`` if it has none."""
+    budget = getattr(view, "query_budget", None)
+    if budget is None:
+        budget = getattr(getattr(view, "view_class", None), "query_budget", None)
+    return budget
+
+
+@contextmanager
+def check_query_budget(budget, name="block"):
+    """Fail with :class:`QueryBudgetExceeded` if the block runs over ``budget``.
+
+    ``budget`` is a number or a view carrying a :func:`query_budget`.
+    """
+    if not isinstance(budget, int):
+        budget = get_query_budget(budget)
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        yield counter
+    if counter.count > budget:
+        raise QueryBudgetExceeded(counter.report(name, budget))
+
+
+class QueryBudgetMiddleware:
+    """Check the queries of requests to views with a :func:`query_budget`."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        match = request.resolver_match
+        budget = get_query_budget(match.func) if match else None
+        if budget is not None and counter.count > budget:
+            report = counter.report(match.view_name, budget)
+            if settings.QUERY_BUDGET_RAISE:
+                raise QueryBudgetExceeded(report)
+            logger.warning(report)
+        return response
@@ -1,8 +1,13 @@
-from string import Template
+import re
+from collections import defaultdict
+from itertools import chain
 
 from rest_framework import serializers
 
+from apps.core.maptemplates import get_map_template
+from apps.domdata.catalog import get_catalog
 from apps.domdata.models import Nation, Unit
+from apps.domdata.stats import get_stat_table
 
 
 class NationSerializer(serializers.ModelSerializer):
@@ -19,47 +24,125 @@ class UnitSerializer(serializers.ModelSerializer):
         fields = ["dominion_id", "name"]
 
 
+class UnitStatsSerializer(UnitSerializer):
+    """A unit with the ``BaseU.csv`` stats listed in the ``stats`` context."""
+
+    stats = serializers.SerializerMethodField()
+
+    class Meta(UnitSerializer.Meta):
+        fields = UnitSerializer.Meta.fields + ["commander", "stats"]
+
+    def get_stats(self, unit):
+        return get_stat_table().get_row(unit.dominion_id, self.context["stats"])
+
+
 ERAS = {"EA": 1, "MA": 2, "LA": 3}
 
 
-def nation_exists(value):
-    age, nation = value.split(")")
+NATION_FIELDS = ["land_nation_1", "land_nation_2", "water_nation_1", "water_nation_2"]
+UNIT_FIELDS = ["commanders", "units"]
+# Leadership of commanders without stats, the most common one in BaseU.csv.
+DEFAULT_LEADERSHIP = 40
+
+
+def parse_nation(value):
+    """Split ``"(EA) Ulm"`` into ``("EA", "Ulm")``, returning ``None`` if malformed."""
+    age, bracket, nation = value.partition(")")
     age = age[1:]
-    nation = nation.strip()
-    if not Nation.objects.filter(era=ERAS[age], name=nation).exists():
-        raise serializers.ValidationError(
-            "There is no such nation with name {} in {}".format(nation, age)
-        )
-
-
-def unit_exists(value):
-    for instance in value:
-        dominion_id = instance["dominion_id"]
-        if not Unit.objects.filter(dominion_id=dominion_id).exists():
-            raise serializers.ValidationError(
-                "There is no such unit with dominion_id {}".format(dominion_id)
-            )
+    if not bracket or age not in ERAS:
+        return None
+    return age, nation.strip()
+
+
+def to_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_quantity(value):
+    """Return a unit quantity as a positive int, ``None`` if it is not one."""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    quantity = to_int(value, None)
+    return quantity if quantity is not None and quantity > 0 else None
+
+
+def get_leadership(dominion_id):
+    """Return the leadership of a commander, ``DEFAULT_LEADERSHIP`` without stats."""
+    stats = get_stat_table().get_row(int(dominion_id), ["leader"])
+    return stats["leader"] if stats else DEFAULT_LEADERSHIP
+
+
+def pack_units(capacities, stacks):
+    """Spread ``(unit_id, quantity)`` stacks over commanders in one pass.
+
+    Commanders are filled in order up to their capacity, splitting stacks
+    between commanders when needed. Units beyond the total capacity are given
+    to the last commander and counted as overflow. Returns the stacks of every
+    commander and the overflow.
+    """
+    packed = [[] for _ in capacities]
+    if not capacities:
+        return packed, sum(quantity for _, quantity in stacks)
+    index, room, last, overflow = 0, capacities[0], len(capacities) - 1, 0
+    for unit_id, quantity in stacks:
+        while quantity > 0:
+            while room <= 0 and index < last:
+                index += 1
+                room = capacities[index]
+            taken = min(quantity, room) if room > 0 else quantity
+            if room <= 0:
+                overflow += taken
+            commander_stacks = packed[index]
+            if commander_stacks and commander_stacks[-1][0] == unit_id:
+                commander_stacks[-1] = (unit_id, commander_stacks[-1][1] + taken)
+            else:
+                commander_stacks.append((unit_id, taken))
+            quantity -= taken
+            room -= taken
+    return packed, overflow
+
+
+def resolve_nations(values):
+    """Map every nation string to its dominion_id using the catalog."""
+    catalog = get_catalog()
+    resolved = {}
+    for value in set(values):
+        key = parse_nation(value)
+        nation = key and catalog.find_nation(ERAS[key[0]], key[1])
+        if nation:
+            resolved[value] = nation.dominion_id
+    return resolved
+
+
+def resolve_units(values):
+    """Return the subset of dominion_ids that exist in the catalog."""
+    units = get_catalog().units
+    existing = set()
+    for value in values:
+        try:
+            if int(value) in units:
+                existing.add(value)
+        except (TypeError, ValueError):
+            continue
+    return existing
 
 
 class GenerateMapSerializer(serializers.Serializer):
     LAND_STARTS, WATER_STARTS = (5, 8), (12, 14)
-    land_nation_1 = serializers.CharField(
-        required=False, validators=[nation_exists], allow_blank=True
-    )
-    land_nation_2 = serializers.CharField(
-        required=False, validators=[nation_exists], allow_blank=True
-    )
-    water_nation_1 = serializers.CharField(
-        required=False, validators=[nation_exists], allow_blank=True
-    )
-    water_nation_2 = serializers.CharField(
-        required=False, validators=[nation_exists], allow_blank=True
-    )
-    commanders = serializers.ListField(required=False, validators=[unit_exists])
-    units = serializers.ListField(required=False, validators=[unit_exists])
+    land_nation_1 = serializers.CharField(required=False, allow_blank=True)
+    land_nation_2 = serializers.CharField(required=False, allow_blank=True)
+    water_nation_1 = serializers.CharField(required=False, allow_blank=True)
+    water_nation_2 = serializers.CharField(required=False, allow_blank=True)
+    commanders = serializers.ListField(required=False)
+    units = serializers.ListField(required=False)
     use_cave_map = serializers.BooleanField(required=False, default=False)
 
     def validate(self, data):
+        self.validate_references(data)
+        self.validate_leadership(data)
         nations_list = [
             data.get("land_nation_1"),
             data.get("land_nation_2"),
@@ -70,30 +153,117 @@ class GenerateMapSerializer(serializers.Serializer):
             raise serializers.ValidationError("You should select at least 2 nations")
         return data
 
+    def validate_references(self, data):
+        """Check every referenced nation and unit exists in the catalog.
+
+        No query is run per nation or unit. Resolved nation dominion_ids are kept
+        in ``nation_ids`` for ``process_data``. Unit stacks also need a positive
+        whole ``quantity``, anything else would drop them from the map.
+        """
+        nations = {field: data.get(field) for field in NATION_FIELDS if data.get(field)}
+        self.nation_ids = resolve_nations(nations.values())
+        unit_ids = {
+            field: [
+                str(instance.get("dominion_id")) for instance in data.get(field, [])
+            ]
+            for field in UNIT_FIELDS
+        }
+        existing_units = resolve_units(chain.from_iterable(unit_ids.values()))
+        errors = {}
+        for field, value in nations.items():
+            if value in self.nation_ids:
+                continue
+            key = parse_nation(value)
+            if key is None:
+                errors[field] = [
+                    "{} is not a nation like (EA) Ulm, eras are {}".format(
+                        value, ", ".join(ERAS)
+                    )
+                ]
+            else:
+                errors[field] = [
+                    "There is no such nation with name {} in {}".format(key[1], key[0])
+                ]
+        for field, dominion_ids in unit_ids.items():
+            messages = []
+            for dominion_id, instance in zip(dominion_ids, data.get(field, [])):
+                if dominion_id not in existing_units:
+                    messages.append(
+                        "There is no such unit with dominion_id {}".format(dominion_id)
+                    )
+                quantity = instance.get("quantity")
+                if field == "units" and parse_quantity(quantity) is None:
+                    messages.append(
+                        "Unit with dominion_id {} needs a positive whole quantity, "
+                        "not {!r}".format(dominion_id, quantity)
+                    )
+            if messages:
+                errors[field] = messages
+        if errors:
+            raise serializers.ValidationError(errors)
+
+    def validate_leadership(self, data):
+        """Check the commanders of every nation can lead all of its units.
+
+        Units beyond the leadership of their commanders would be left out of
+        the game, so such armies are rejected, per nation field.
+        """
+        leadership, troops = defaultdict(int), defaultdict(int)
+        for commander in data.get("commanders", []):
+            nation = commander.get("for_nation")
+            leadership[nation] += get_leadership(commander["dominion_id"])
+        for unit in data.get("units", []):
+            troops[unit.get("for_nation")] += parse_quantity(unit["quantity"])
+        errors = {}
+        for field in NATION_FIELDS:
+            nation = data.get(field)
+            if not nation or troops[nation] <= leadership[nation]:
+                continue
+            if leadership[nation]:
+                message = "The commanders of {} lead {} units, not {}".format(
+                    nation, leadership[nation], troops[nation]
+                )
+            else:
+                message = "{} has {} units but no commanders".format(
+                    nation, troops[nation]
+                )
+            errors[field] = [message]
+        if errors:
+            raise serializers.ValidationError(errors)
+
     def process_data(self, data):
+        """Group commanders and units by nation and spread units over commanders.
+
+        Inputs are grouped in one pass, then the unit stacks of every nation
+        are packed onto its commanders by leadership, see :func:`pack_units`.
+        ``validate_leadership`` makes sure they fit.
+        """
         nations_list = [
             data["land_nation_1"],
             data["land_nation_2"],
             data["water_nation_1"],
             data["water_nation_2"],
         ]
+        commanders_by_nation, units_by_nation = defaultdict(list), defaultdict(list)
+        for commander in data.get("commanders", []):
+            commanders_by_nation[commander["for_nation"]].append(commander)
+        for unit in data.get("units", []):
+            units_by_nation[unit["for_nation"]].append(
+                (unit["dominion_id"], parse_quantity(unit["quantity"]))
+            )
         returned_data = []
         for index, nation in enumerate(nations_list):
             if not bool(nation):
                 continue
-            units = [x for x in data["units"] if x["for_nation"] == nation]
-            commanders = [x for x in data["commanders"] if x["for_nation"] == nation]
-            age, nation_name = nation.split(")")
-            age = age[1:]
-            nation_name = nation_name.strip()
-            dominion_id = Nation.objects.get(
-                era=ERAS[age], name=nation_name
-            ).dominion_id
+            commanders = commanders_by_nation[nation]
+            dominion_id = self.nation_ids[nation]
             land_type = "land" if index < 2 else "water"
             nation_dict = {dominion_id: [], "land_type": land_type}
-            for commander in commanders:
+            capacities = [get_leadership(x["dominion_id"]) for x in commanders]
+            packed, _ = pack_units(capacities, units_by_nation[nation])
+            for commander, units in zip(commanders, packed):
                 magic = commander.get("magic")
-                commander_data = {"units": []}
+                commander_data = {"units": units}
                 if magic:
                     commander_data["magic"] = {}
                     for key, value in magic.items():
@@ -101,18 +271,29 @@ class GenerateMapSerializer(serializers.Serializer):
                 nation_dict[dominion_id].append(
                     {commander["dominion_id"]: commander_data}
                 )
-            commander_index, max_index = 0, len(commanders) - 1
-            for index, unit in enumerate(units, start=0):
-                if index % 3 == 0 and commander_index != max_index:
-                    commander_index += 1
-                commander_to_append = nation_dict[dominion_id][commander_index]
-                commander_id = list(commander_to_append)[0]
-                commander_to_append[commander_id]["units"].append(
-                    (unit["dominion_id"], unit["quantity"])
-                )
             returned_data.append(nation_dict)
         return returned_data
 
+    def get_summary(self, data):
+        """Summarize the army of every nation of the ``process_data`` output.
+
+        Quantities which are not numbers count as 0.
+        """
+        table = get_stat_table()
+        summary = []
+        for nation_data in data:
+            nation_id = list(nation_data.keys())[0]
+            commanders, units = [], []
+            for commander in nation_data[nation_id]:
+                for commander_id, commander_data in commander.items():
+                    commanders.append(int(commander_id))
+                    for unit_id, amount in commander_data.get("units", []):
+                        units.append((int(unit_id), to_int(amount)))
+            nation_summary = {"nation": nation_id}
+            nation_summary.update(table.summarize_army(commanders, units))
+            summary.append(nation_summary)
+        return summary
+
     def data_into_map(self, data):
         order_to_map_position = {
             "land": [self.LAND_STARTS[0], self.LAND_STARTS[1]],
@@ -147,33 +328,116 @@ class GenerateMapSerializer(serializers.Serializer):
             returned_data.append(f_string)
         return returned_data
 
-    def substitute(self, data):
+    @property
+    def map_name(self):
+        return "Arena_with_cave" if self.validated_data.get("use_cave_map") else "Arena"
+
+    def get_title(self):
+        validated_data = self.validated_data
+        nations_list = [
+            validated_data.get("land_nation_1"),
+            validated_data.get("land_nation_2"),
+            validated_data.get("water_nation_1"),
+            validated_data.get("water_nation_2"),
+        ]
+        add_string = " vs ".join(nation for nation in nations_list if nation)
+        return f"{self.map_name}_{add_string}"
+
+    def get_context(self, data):
         data_dict = {f"nation{x}": y for x, y in enumerate(data, start=1)}
         required_keys = [f"nation{x}" for x in range(1, 5)]
         for key in required_keys:
             if key not in data_dict:
                 data_dict[key] = ""
-        map_name = (
-            "Arena_with_cave" if self.validated_data.get("use_cave_map") else "Arena"
-        )
-        with open(f"apps/core/data/{map_name}.map", "r") as mapfile:
-            data = self.validated_data
-            nations_list = [
-                data.get("land_nation_1"),
-                data.get("land_nation_2"),
-                data.get("water_nation_1"),
-                data.get("water_nation_2"),
+        data_dict["map_name"] = self.get_title()
+        return data_dict
+
+    def substitute(self, data):
+        template = get_map_template(self.map_name)
+        return template.render(self.get_context(data))
+
+    def stream(self, data, compress=False):
+        """Iterate the map as bytes, as gzip members with ``compress``."""
+        template = get_map_template(self.map_name)
+        if compress:
+            return template.iter_gzip(self.get_context(data))
+        return template.iter_encoded(self.get_context(data))
+
+    def get_filename(self):
+        title = re.sub(r"(?:[^\w.-]|_)+", "_", self.get_title())
+        return "{}.map".format(title.strip("_"))
+
+    def canonical_payload(self):
+        """Return only the parts of the validated data that shape the map.
+
+        Display names and the client side ``id`` of commanders and units are
+        dropped and quantities and magic levels are normalized to strings, so
+        equal matchups produce equal payloads. Order is kept, it shows in the map.
+        """
+        data = self.validated_data
+        commanders = [
+            [
+                str(commander["dominion_id"]),
+                commander["for_nation"],
+                [
+                    [key.lower(), str(value)]
+                    for key, value in (commander.get("magic") or {}).items()
+                ],
             ]
-            add_string, index = "", 0
-            for nation in nations_list:
-                if nation:
-                    if not index:
-                        add_string += nation
-                        index += 1
-                    else:
-                        add_string += " vs {}".format(nation)
-            final_map_name = f"{map_name}_{add_string}"
-            data_dict["map_name"] = final_map_name
-            src = Template(mapfile.read())
-            result = src.substitute(data_dict)
-        return result
+            for commander in data.get("commanders", [])
+        ]
+        units = [
+            [str(unit["dominion_id"]), unit["for_nation"], str(unit["quantity"])]
+            for unit in data.get("units", [])
+        ]
+        return {
+            "land_nation_1": data.get("land_nation_1") or "",
+            "land_nation_2": data.get("land_nation_2") or "",
+            "water_nation_1": data.get("water_nation_1") or "",
+            "water_nation_2": data.get("water_nation_2") or "",
+            "use_cave_map": bool(data.get("use_cave_map")),
+            "commanders": commanders,
+            "units": units,
+        }
+
+
+class SuggestArmiesSerializer(serializers.Serializer):
+    nation_1 = serializers.IntegerField()
+    nation_2 = serializers.IntegerField()
+    gold = serializers.IntegerField(min_value=1, max_value=100000)
+    resources = serializers.IntegerField(min_value=1, required=False)
+
+    def validate(self, data):
+        catalog = get_catalog()
+        errors = {
+            field: ["There is no such nation with dominion_id {}".format(data[field])]
+            for field in ("nation_1", "nation_2")
+            if data[field] not in catalog.nations
+        }
+        if errors:
+            raise serializers.ValidationError(errors)
+        return data
+
+
+class ArmySerializer(serializers.Serializer):
+    """An ``Army`` suggestion, units with ``dominion_id``, ``name`` and ``quantity``."""
+
+    commanders = serializers.SerializerMethodField()
+    troops = serializers.SerializerMethodField()
+    gold = serializers.IntegerField()
+    resources = serializers.IntegerField()
+    hp = serializers.IntegerField()
+    leadership = serializers.IntegerField()
+
+    @staticmethod
+    def units_data(units):
+        return [
+            {"dominion_id": unit.dominion_id, "name": unit.name, "quantity": quantity}
+            for unit, quantity in units
+        ]
+
+    def get_commanders(self, army):
+        return self.units_data(army.commanders)
+
+    def get_troops(self, army):
+        return self.units_data(army.troops)
@@ -1,21 +1,47 @@
 import copy
+import gzip
+from string import Template
 from unittest import mock
 
 from django.urls import reverse
 
 import pytest
 
+from apps.core import mapcache
 from apps.core.factories import NationFactory, UnitFactory
+from apps.core.maptemplates import MapTemplate, get_map_template
+from apps.core.metrics import Histogram, stage_histogram
+from apps.core.querybudget import (
+    QueryBudgetExceeded,
+    check_query_budget,
+    fingerprint,
+)
 from apps.core.serializers import (
     GenerateMapSerializer,
     NationSerializer,
     UnitSerializer,
+    pack_units,
+)
+from apps.core.views import (
+    AutocompleteNationsView,
+    AutocompleteUnitsView,
+    generate_map,
 )
+from apps.core.warmup import warmup
+from apps.domdata.armies import clear_suggestions, get_candidates
+from apps.domdata.catalog import get_catalog, invalidate_catalog
 from apps.domdata.models import Nation, Unit
+from apps.domdata.parser import import_data
+from apps.domdata.stats import DEFAULT_STATS
 
 pytestmark = pytest.mark.django_db()
 
 
+@pytest.fixture(autouse=True)
+def clear_map_cache():
+    mapcache.local_cache.clear()
+
+
 @pytest.fixture
 def prepare_data():
     NationFactory.create_batch(10, **{"modded": 1})
@@ -200,16 +226,56 @@ def test_generate_map_serializer_processed_data(data_for_mapgen):
                 {
                     "1786": {
                         "magic": {"mag_fire": "2", "mag_blood": "2"},
-                        "units": [("105", "10")],
+                        "units": [("105", 10)],
                     }
                 }
             ],
             "land_type": "land",
         },
-        {nation2.dominion_id: [{"7": {"units": [("408", "10")]}}], "land_type": "land"},
+        {nation2.dominion_id: [{"7": {"units": [("408", 10)]}}], "land_type": "land"},
     ]
 
 
+@pytest.mark.parametrize(
+    "capacities,stacks,expected,overflow",
+    [
+        ([40], [("1", 10), ("2", 5)], [[("1", 10), ("2", 5)]], 0),
+        ([10, 0, 40], [("1", 25)], [[("1", 10)], [], [("1", 15)]], 0),
+        ([10, 10], [("1", 5), ("2", 20)], [[("1", 5), ("2", 5)], [("2", 15)]], 5),
+        ([], [("1", 5)], [], 5),
+    ],
+)
+def test_pack_units(capacities, stacks, expected, overflow):
+    assert pack_units(capacities, stacks) == (expected, overflow)
+
+
+def test_generate_map_serializer_splits_units_by_leadership(data_for_mapgen):
+    data, nation1, nation2 = data_for_mapgen
+    data = copy.deepcopy(data)
+    data["commanders"].append(dict(data["commanders"][0], magic={}))
+    data["units"][0]["quantity"] = "80"
+    serializer = GenerateMapSerializer(data=data)
+    assert serializer.is_valid()
+    returned_data = serializer.process_data(serializer.validated_data)
+    assert [list(x.values())[0] for x in returned_data[0][nation1.dominion_id]] == [
+        {"magic": {"mag_fire": "2", "mag_blood": "2"}, "units": [("105", 40)]},
+        {"units": [("105", 40)]},
+    ]
+
+
+def test_generate_map_serializer_rejects_units_beyond_leadership(data_for_mapgen):
+    data, nation1, nation2 = data_for_mapgen
+    data = copy.deepcopy(data)
+    data["units"][0]["quantity"] = "41"
+    del data["commanders"][1]
+    serializer = GenerateMapSerializer(data=data)
+    assert not serializer.is_valid()
+    assert serializer.errors == {
+        "land_nation_1": ["The commanders of (EA) Tir na n'Og lead 40 units, not 41"],
+        "land_nation_2": ["(EA) T'ien Ch'i has 10 units but no commanders"],
+    }
+
+
 def test_mapgenerator_function(data_for_mapgen):
     data, nation1, nation2 = data_for_mapgen
     serializer = GenerateMapSerializer(data=data)
@@ -291,11 +357,11 @@ def test_generate_map_serializer_processed_data_with_water_nation(data_for_mapge
     returned_data = serializer.process_data(serializer.validated_data)
     assert returned_data == [
         {
-            nation3.dominion_id: [{"7": {"units": [("408", "10")]}}],
+            nation3.dominion_id: [{"7": {"units": [("408", 10)]}}],
             "land_type": "water",
         },
         {
-            nation4.dominion_id: [{"7": {"units": [("408", "10")]}}],
+            nation4.dominion_id: [{"7": {"units": [("408", 10)]}}],
             "land_type": "water",
         },
     ]
@@ -357,10 +423,12 @@ def test_map_with_cave(data_for_mapgen):
     assert serializer.is_valid()
     returned_data = serializer.process_data(serializer.validated_data)
     mapgenerated_text = serializer.data_into_map(returned_data)
-    mocked_open_function = mock.mock_open(read_data="")
-    with mock.patch("apps.core.serializers.open", mocked_open_function) as mocked:
-        serializer.substitute(mapgenerated_text)
-        mocked.assert_called_once_with("apps/core/data/Arena_with_cave.map", "r")
+    with mock.patch(
+        "apps.core.serializers.get_map_template", wraps=get_map_template
+    ) as mocked:
+        final_map = serializer.substitute(mapgenerated_text)
+        mocked.assert_called_once_with("Arena_with_cave")
+    assert final_map.startswith(get_map_template("Arena_with_cave").chunks[0])
 
 
 def test_final_view(data_for_mapgen, client):
@@ -380,3 +448,630 @@ def test_final_view(data_for_mapgen, client):
     assert mapgenerated_text[1] in final_map
     assert "$nation3" not in final_map
     assert "$nation4" not in final_map
+
+
+def test_map_template_matches_string_template():
+    context = {
+        "map_name": "Arena_(EA) Ulm vs (EA) Marverni",
+        "nation1": "\n#allowedplayer 5",
+        "nation2": "\n#allowedplayer 6",
+        "nation3": "",
+        "nation4": "",
+    }
+    for name in ("Arena", "Arena_with_cave"):
+        with open(f"apps/core/data/{name}.map", "r") as mapfile:
+            expected = Template(mapfile.read()).substitute(context)
+        assert get_map_template(name).render(context) == expected
+
+
+def test_map_template_is_loaded_once():
+    assert get_map_template("Arena") is get_map_template("Arena")
+
+
+def test_map_template_escapes_and_braces():
+    template = MapTemplate("test", "cost $$5 for ${unit}s\n$nation1")
+    assert template.slots == ("unit", "nation1")
+    assert template.render({"unit": "Hoplite", "nation1": 1}) == (
+        "cost $5 for Hoplites\n1"
+    )
+    with pytest.raises(KeyError):
+        template.render({"unit": "Hoplite"})
+    with pytest.raises(ValueError):
+        MapTemplate("test", "broken $ placeholder")
+
+
+def test_final_view_file_output(data_for_mapgen, client):
+    data, nation1, nation2 = data_for_mapgen
+    url = reverse("v0:generate_map") + "?output=file"
+    response = client.post(url, data, content_type="application/json")
+    assert response.status_code == 200
+    assert response.streaming
+    assert response["Content-Type"] == "text/plain; charset=utf-8"
+    assert response["Content-Disposition"] == (
+        'attachment; filename="Arena_EA_Tir_na_n_Og_vs_EA_T_ien_Ch_i.map"'
+    )
+    final_map = b"".join(response.streaming_content).decode()
+    json_response = client.post(
+        reverse("v0:generate_map"), data, content_type="application/json"
+    )
+    assert final_map == json_response.data
+
+
+def test_final_view_file_output_invalid(data_for_mapgen, client):
+    data, nation1, nation2 = data_for_mapgen
+    nation1.delete()
+    url = reverse("v0:generate_map") + "?output=file"
+    response = client.post(url, data, content_type="application/json")
+    assert response.status_code == 400
+
+
+def test_final_view_etag(data_for_mapgen, client):
+    data, *other = data_for_mapgen
+    url = reverse("v0:generate_map")
+    response = client.post(url, data, content_type="application/json")
+    etag = response["ETag"]
+    assert etag.startswith('"') and not etag.startswith("W/")
+    response = client.post(
+        url, data, content_type="application/json", HTTP_IF_NONE_MATCH=etag
+    )
+    assert response.status_code == 304
+    assert response["ETag"] == etag
+    file_response = client.post(
+        url + "?output=file", data, content_type="application/json"
+    )
+    assert file_response["ETag"] != etag
+
+
+def test_final_view_summary(data_for_mapgen, client):
+    data, *other = data_for_mapgen
+    url = reverse("v0:generate_map")
+    plain = client.post(url, data, content_type="application/json")
+    response = client.post(url + "?summary=1", data, content_type="application/json")
+    assert response.status_code == 200
+    assert response.data["map"] == plain.data
+    assert response["ETag"] != plain["ETag"]
+    assert response.data["summary"] == [
+        {
+            "nation": 1,
+            "commanders": 1,
+            "units": 10,
+            # Estimated: Fir Bolg at 13 gold, Woodhenge Druids at 50 + 2 levels.
+            "gold": 13 + (50 + 2 * 30) * 10,
+            "gold_is_estimate": True,
+            "resources": 1 + 1 * 10,
+            "hp": 13 + 9 * 10,
+            "leadership_used": 10,
+            "leadership_available": 40,
+            "missing_stats": [],
+            "estimated_gold": [105, 1786],
+        },
+        {
+            "nation": 2,
+            "commanders": 1,
+            "units": 10,
+            # Water Elementals cost no gold.
+            "gold": 20,
+            "gold_is_estimate": True,
+            "resources": 1 + 1 * 10,
+            "hp": 13 + 30 * 10,
+            "leadership_used": 10,
+            "leadership_available": 40,
+            "missing_stats": [],
+            "estimated_gold": [7],
+        },
+    ]
+
+
+def test_final_view_scenario(data_for_mapgen, client):
+    data, *other = data_for_mapgen
+    url = reverse("v0:generate_map")
+    response = client.post(
+        url + "?output=scenario", data, content_type="application/json"
+    )
+    assert response.status_code == 200
+    context = response.data["context"]
+    assert context["map_name"] == "Arena_(EA) Tir na n'Og vs (EA) T'ien Ch'i"
+    assert context["nation1"].startswith("\n#allowedplayer 1\n#specstart 1 5")
+    assert context["nation3"] == ""
+    template = get_map_template("Arena")
+    assert response.data["base"] == "/api/v0/maps/Arena.{}.map".format(
+        template.fingerprint
+    )
+    base = client.get(response.data["base"])
+    assert base.status_code == 200
+    assert "immutable" in base["Cache-Control"]
+    assert "max-age=31536000" in base["Cache-Control"]
+    spliced = MapTemplate("Arena", base.content.decode()).render(context)
+    assert spliced == client.post(url, data, content_type="application/json").data
+    response = client.get(response.data["base"], HTTP_IF_NONE_MATCH=base["ETag"])
+    assert response.status_code == 304
+    assert client.get("/api/v0/maps/Arena.0123456789abcdef.map").status_code == 404
+    assert (
+        client.get("/api/v0/maps/Other.{}.map".format(template.fingerprint)).status_code
+        == 404
+    )
+
+
+def test_map_template_iter_gzip():
+    template = MapTemplate("test", "#title $title\n$nation1\n$nation2\n#end")
+    context = {"title": "Arena", "nation1": "#allowedplayer 5", "nation2": ""}
+    members = list(template.iter_gzip(context))
+    assert members[0] is template.gzip_chunks[0]
+    assert len(members) == 6
+    assert gzip.decompress(b"".join(members)).decode() == template.render(context)
+
+
+def test_final_view_file_output_gzip(data_for_mapgen, client):
+    data, *other = data_for_mapgen
+    url = reverse("v0:generate_map")
+    plain = client.post(url + "?output=file", data, content_type="application/json")
+    response = client.post(
+        url + "?output=file",
+        data,
+        content_type="application/json",
+        HTTP_ACCEPT_ENCODING="gzip, deflate, br",
+    )
+    assert response.status_code == 200
+    assert response["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response["Vary"]
+    assert response["ETag"] != plain["ETag"]
+    content = b"".join(response.streaming_content)
+    assert gzip.decompress(content) == b"".join(plain.streaming_content)
+    assert len(content) < 30000
+    base_url = client.post(
+        url + "?output=scenario", data, content_type="application/json"
+    ).data["base"]
+    base = client.get(base_url, HTTP_ACCEPT_ENCODING="gzip")
+    assert base["Content-Encoding"] == "gzip"
+    assert gzip.decompress(base.content) == get_map_template("Arena").source
+
+
+def test_final_view_uses_cache(data_for_mapgen, client):
+    data, *other = data_for_mapgen
+    url = reverse("v0:generate_map")
+    first = client.post(url, data, content_type="application/json")
+    reordered = copy.deepcopy(data)
+    for item in reordered["commanders"] + reordered["units"]:
+        item["id"] = "another-client-id"
+    with mock.patch.object(GenerateMapSerializer, "process_data") as mocked:
+        second = client.post(url, reordered, content_type="application/json")
+        assert not mocked.called
+    assert second.data == first.data
+    assert second["ETag"] == first["ETag"]
+
+
+def test_final_view_streams_file_while_caching(data_for_mapgen, client):
+    data, *other = data_for_mapgen
+    url = reverse("v0:generate_map") + "?output=file"
+    response = client.post(url, data, content_type="application/json")
+    assert response.streaming
+    chunks = iter(response.streaming_content)
+    first_chunk = next(chunks)
+    assert len(mapcache.local_cache) == 0
+    content = first_chunk + b"".join(chunks)
+    assert len(mapcache.local_cache) == 1
+    with mock.patch.object(GenerateMapSerializer, "process_data") as mocked:
+        cached = client.post(url, data, content_type="application/json")
+        assert not mocked.called
+    assert b"".join(cached.streaming_content) == content
+    assert cached["ETag"] == response["ETag"]
+
+
+def test_map_cache_evicts_by_size():
+    cache = mapcache.MapCache(max_bytes=10)
+    cache.set("a", b"1234")
+    cache.set("b", b"1234")
+    assert cache.get("a") == b"1234"
+    cache.set("c", b"1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234"
+    assert cache.size == 8
+    cache.set("d", b"12345678901")
+    assert cache.get("d") is None
+    assert len(cache) == 2
+
+
+def test_final_view_etag_covers_template_and_render_version(data_for_mapgen, client):
+    data, *other = data_for_mapgen
+    url = reverse("v0:generate_map")
+    etag = client.post(url, data, content_type="application/json")["ETag"]
+    with mock.patch("apps.core.views.RENDER_VERSION", mapcache.RENDER_VERSION + 1):
+        assert client.post(url, data, content_type="application/json")["ETag"] != etag
+    template = get_map_template("Arena")
+    with mock.patch.object(template, "fingerprint", "0" * 16):
+        assert client.post(url, data, content_type="application/json")["ETag"] != etag
+    assert client.post(url, data, content_type="application/json")["ETag"] == etag
+
+
+def test_canonical_key_is_order_independent():
+    assert mapcache.canonical_key({"a": 1, "b": [1, 2]}) == mapcache.canonical_key(
+        {"b": [1, 2], "a": 1}
+    )
+    assert mapcache.canonical_key({"a": 1}) != mapcache.canonical_key({"a": 1}, "2")
+
+
+def test_final_view_shared_cache(data_for_mapgen, client, settings):
+    settings.MAP_CACHE_ALIAS = "default"
+    data, *other = data_for_mapgen
+    url = reverse("v0:generate_map")
+    first = client.post(url, data, content_type="application/json")
+    mapcache.local_cache.clear()
+    with mock.patch.object(GenerateMapSerializer, "process_data") as mocked:
+        second = client.post(url, data, content_type="application/json")
+        assert not mocked.called
+    assert second.data == first.data
+    assert len(mapcache.local_cache) == 1
+
+
+def test_generate_map_serializer_reports_every_missing_reference(data_for_mapgen):
+    data, *other = data_for_mapgen
+    data = copy.deepcopy(data)
+    data["land_nation_2"] = "(LA) Nowhere"
+    data["water_nation_1"] = "Ulm"
+    data["water_nation_2"] = "(XX) Ulm"
+    data["units"][0]["dominion_id"] = "999999"
+    data["units"][1]["dominion_id"] = "not a number"
+    serializer = GenerateMapSerializer(data=data)
+    assert not serializer.is_valid()
+    assert serializer.errors["land_nation_2"] == [
+        "There is no such nation with name Nowhere in LA"
+    ]
+    assert serializer.errors["water_nation_1"] == [
+        "Ulm is not a nation like (EA) Ulm, eras are EA, MA, LA"
+    ]
+    assert serializer.errors["water_nation_2"] == [
+        "(XX) Ulm is not a nation like (EA) Ulm, eras are EA, MA, LA"
+    ]
+    assert "water_nation_1" in serializer.errors
+    assert serializer.errors["units"] == [
+        "There is no such unit with dominion_id 999999",
+        "There is no such unit with dominion_id not a number",
+    ]
+    assert "commanders" not in serializer.errors
+
+
+@pytest.mark.parametrize("quantity", ["many", "0", -3, 2.5, None, True])
+def test_generate_map_serializer_rejects_bad_quantities(data_for_mapgen, quantity):
+    data, *other = data_for_mapgen
+    data = copy.deepcopy(data)
+    data["units"][1]["quantity"] = quantity
+    serializer = GenerateMapSerializer(data=data)
+    assert not serializer.is_valid()
+    assert serializer.errors["units"] == [
+        "Unit with dominion_id {} needs a positive whole quantity, not {!r}".format(
+            data["units"][1]["dominion_id"], quantity
+        )
+    ]
+
+
+def test_generate_map_serializer_query_count_is_constant(
+    data_for_mapgen, django_assert_num_queries
+):
+    data, *other = data_for_mapgen
+    data = copy.deepcopy(data)
+    UnitFactory.create_batch(50)
+    unit_ids = list(Unit.objects.values_list("dominion_id", flat=True))
+    for index, dominion_id in enumerate(unit_ids):
+        nation = data["land_nation_1" if index % 2 else "land_nation_2"]
+        data["units"].append(
+            {"dominion_id": str(dominion_id), "for_nation": nation, "quantity": "5"}
+        )
+        data["commanders"].append({"dominion_id": "1786", "for_nation": nation})
+    serializer = GenerateMapSerializer(data=data)
+    get_catalog()
+    with django_assert_num_queries(0):
+        assert serializer.is_valid()
+    with django_assert_num_queries(0):
+        serializer.process_data(serializer.validated_data)
+
+
+def test_autocomplete_units_fuzzy_search(client):
+    unit = UnitFactory(dominion_id=20, name="Myrmidon", nation_set=[])
+    url = reverse("v0:autocomplete_units_view") + "?search=mirmidon"
+    assert client.get(url).data == []
+    response = client.get(url + "&fuzzy=1")
+    assert response.status_code == 200
+    assert response.data[0] == UnitSerializer(unit).data
+
+
+def test_autocomplete_units_pagination(prepare_data, client, settings):
+    settings.AUTOCOMPLETE_MAX_LIMIT = 4
+    url = reverse("v0:autocomplete_units_view") + "?modded=1,2"
+    response = client.get(url)
+    assert len(response.data) == 4
+    total = int(response["X-Total-Count"])
+    assert total == Unit.objects.filter(modded__in=[1, 2]).count()
+    assert 'rel="next"' in response["Link"]
+    response = client.get(url + "&limit=100&offset=2")
+    assert len(response.data) == 4
+    assert 'rel="prev"' in response["Link"]
+    response = client.get(url + f"&limit=2&offset={total - 2}")
+    assert len(response.data) == 2
+    assert 'rel="next"' not in response["Link"]
+
+
+def test_autocomplete_units_search_pagination(client, settings):
+    settings.AUTOCOMPLETE_SEARCH_LIMIT = 3
+    for dominion_id in range(1, 9):
+        UnitFactory(dominion_id=dominion_id, name="Hoplite", nation_set=[])
+    UnitFactory(dominion_id=9, name="Militia", nation_set=[])
+    url = reverse("v0:autocomplete_units_view") + "?search=hop"
+    response = client.get(url)
+    assert len(response.data) == 3
+    assert response["X-Total-Count"] == "8"
+    assert 'rel="next"' in response["Link"]
+    response = client.get(url + "&limit=5&offset=5")
+    assert [x["dominion_id"] for x in response.data] == [6, 7, 8]
+    assert 'rel="next"' not in response["Link"]
+
+
+@pytest.mark.parametrize("test_input,expected", [("1", True), ("0", False)])
+def test_autocomplete_units_commander_filter(
+    prepare_data, client, test_input, expected
+):
+    url = reverse("v0:autocomplete_units_view") + f"?commander={test_input}"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert {x["dominion_id"] for x in response.data} == set(
+        Unit.objects.filter(modded=Unit.VANILLA, commander=expected).values_list(
+            "dominion_id", flat=True
+        )
+    )
+
+
+def test_nation_roster(client, django_assert_num_queries):
+    nation = NationFactory(era=1, name="Ulm", dominion_id=5)
+    other = NationFactory(era=1, name="Marverni", dominion_id=6)
+    commander = UnitFactory(dominion_id=10, commander=True, nation_set=[])
+    troop = UnitFactory(dominion_id=11, commander=False, nation_set=[])
+    modded = UnitFactory(dominion_id=12, commander=False, modded=Unit.DE, nation_set=[])
+    foreign = UnitFactory(dominion_id=13, commander=False, nation_set=[])
+    for unit in (commander, troop, modded):
+        unit.nations.set([nation])
+    foreign.nations.set([other])
+    url = reverse("v0:nation_roster", kwargs={"dominion_id": nation.dominion_id})
+    get_catalog()
+    with django_assert_num_queries(0):
+        response = client.get(url)
+    assert response.status_code == 200
+    assert response.data["nation"] == NationSerializer(nation).data
+    assert response.data["commanders"] == [UnitSerializer(commander).data]
+    assert response.data["troops"] == [UnitSerializer(troop).data]
+    assert "max-age" in response["Cache-Control"]
+    response = client.get(url + "?modded=1,2", HTTP_IF_NONE_MATCH=response["ETag"])
+    assert response.status_code == 200
+    assert response.data["troops"] == UnitSerializer([troop, modded], many=True).data
+    response = client.get(url + "?modded=1,2", HTTP_IF_NONE_MATCH=response["ETag"])
+    assert response.status_code == 304
+
+
+def test_nation_roster_not_found(client):
+    url = reverse("v0:nation_roster", kwargs={"dominion_id": 999})
+    assert client.get(url).status_code == 404
+
+
+def test_unit_definition(client):
+    UnitFactory(dominion_id=6550, name="Ghulam", modded=Unit.DE, nation_set=[])
+    UnitFactory(dominion_id=6551, name="Ghulam Spearman", nation_set=[])
+    url = reverse("v0:unit_definition", kwargs={"dominion_id": 6550})
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.data["name"] == "Ghulam"
+    assert ["#armor", "leather cap"] in response.json()["definition"]
+    url = reverse("v0:unit_definition", kwargs={"dominion_id": 6551})
+    assert client.get(url).status_code == 404
+    url = reverse("v0:nation_definition", kwargs={"dominion_id": 999})
+    assert client.get(url).status_code == 404
+
+
+def test_unit_stats(client):
+    for dominion_id, commander in ((5, True), (150, False), (211, False), (216, True)):
+        UnitFactory(dominion_id=dominion_id, commander=commander, nation_set=[])
+    url = reverse("v0:unit_stats_view")
+    response = client.get(url + "?leader__gte=40&ordering=-gcost&stats=gcost,leader")
+    assert response.status_code == 200
+    assert response.data == [
+        {"dominion_id": 216, "name": mock.ANY, "commander": True, "stats": mock.ANY},
+        {"dominion_id": 150, "name": mock.ANY, "commander": False, "stats": mock.ANY},
+        {"dominion_id": 211, "name": mock.ANY, "commander": False, "stats": mock.ANY},
+        {"dominion_id": 5, "name": mock.ANY, "commander": True, "stats": mock.ANY},
+    ]
+    assert response.data[0]["stats"] == {"gcost": 260, "leader": 80}
+    # Serpent Lord costs 45 gold more than the game computes, an unknown cost.
+    assert response.data[3]["stats"] == {"gcost": None, "leader": 60}
+    response = client.get(url + "?gcost__lte=100")
+    assert [x["dominion_id"] for x in response.data] == [150, 211]
+    response = client.get(url + "?commander=1&leader=60")
+    assert [x["dominion_id"] for x in response.data] == [5]
+    assert set(response.data[0]["stats"]) == set(DEFAULT_STATS)
+    for query in ("hp__in=1", "hp=x", "ordering=speed", "stats=speed"):
+        assert client.get(url + "?" + query).status_code == 400
+
+
+def test_suggest_armies(client):
+    ulm = NationFactory(era=1, name="Ulm", dominion_id=5)
+    pythium = NationFactory(era=1, name="Pythium", dominion_id=6)
+    for dominion_id, commander, nation in (
+        (216, True, ulm),
+        (211, False, ulm),
+        (243, False, ulm),
+        (226, True, pythium),
+        (150, False, pythium),
+    ):
+        unit = UnitFactory(dominion_id=dominion_id, commander=commander, nation_set=[])
+        unit.nations.set([nation])
+    url = reverse("v0:suggest_armies") + "?nation_1=5&nation_2=6&gold=1000"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert [x["nation"]["dominion_id"] for x in response.data] == [5, 6]
+    first, second = (x["army"] for x in response.data)
+    assert 950 <= first["gold"] <= 1000
+    assert first["gold"] == second["gold"]
+    for army in (first, second):
+        assert army["commanders"]
+        assert sum(x["quantity"] for x in army["troops"]) <= army["leadership"]
+    assert client.get(url).data == response.data
+    # The search is bounded by moves, not time: rebuilt suggestions are identical.
+    clear_suggestions()
+    assert client.get(url).data == response.data
+    url = reverse("v0:suggest_armies") + "?nation_1=5&nation_2=999&gold=500"
+    assert client.get(url).status_code == 400
+    NationFactory(era=1, name="Empty", dominion_id=99)
+    url = reverse("v0:suggest_armies") + "?nation_1=5&nation_2=99&gold=1000"
+    response = client.get(url)
+    assert response.status_code == 400
+    assert response.data == {"nation_2": ["Nation 99 has no commanders and troops"]}
+    url = reverse("v0:suggest_armies") + "?nation_1=5&nation_2=6&gold=10"
+    response = client.get(url)
+    assert response.status_code == 400
+    assert response.data == {"nation_1": ["Nation 5 has no army within 10 gold"]}
+
+
+def test_suggest_armies_real_rosters(client):
+    import_data()
+    invalidate_catalog()
+    # Ulm against T'ien Ch'i, whose units mostly have a relative cost.
+    url = reverse("v0:suggest_armies") + "?nation_1=7&nation_2=10&gold=1000"
+    response = client.get(url)
+    assert response.status_code == 200
+    first, second = (x["army"] for x in response.data)
+    assert 950 <= min(first["gold"], second["gold"])
+    assert max(first["gold"], second["gold"]) <= 1000
+    assert abs(first["gold"] - second["gold"]) <= 10
+    for army in (first, second):
+        assert army["commanders"] and army["troops"]
+    catalog = get_catalog()
+    for nation_id in catalog.rosters:
+        commanders, troops = catalog.get_roster(nation_id, (Unit.VANILLA,))
+        if commanders and troops:
+            assert get_candidates(commanders) and get_candidates(troops)
+
+
+def test_histogram_samples():
+    histogram = Histogram(buckets=(0.1, 1))
+    labels = (("endpoint", "generate_map"),)
+    for value in (0.05, 0.5, 0.5, 3):
+        histogram.observe(labels, value)
+    assert list(histogram.samples()) == [
+        ("_bucket", labels + (("le", "0.1"),), 1),
+        ("_bucket", labels + (("le", "1"),), 3),
+        ("_bucket", labels + (("le", "+Inf"),), 4),
+        ("_sum", labels, 4.05),
+        ("_count", labels, 4),
+    ]
+
+
+def test_server_timing_and_metrics(data_for_mapgen, client):
+    stage_histogram.clear()
+    data, *other = data_for_mapgen
+    response = client.post(
+        reverse("v0:generate_map"), data, content_type="application/json"
+    )
+    stages = [x.split(";")[0] for x in response["Server-Timing"].split(", ")]
+    assert stages == [
+        "is_valid",
+        "process_data",
+        "data_into_map",
+        "substitute",
+        "join",
+        "total",
+    ]
+    response = client.get(reverse("v0:autocomplete_units_view") + "?modded=2,1")
+    assert response["Server-Timing"].startswith("query;dur=")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = response.content.decode()
+    assert "# TYPE dom5_request_stage_seconds histogram" in text
+    assert (
+        'dom5_request_stage_seconds_count{endpoint="generate_map",mods="1",'
+        'stage="substitute"} 1'
+    ) in text
+    assert (
+        'dom5_request_stage_seconds_bucket{endpoint="autocomplete_units_view",'
+        'mods="1-2",stage="serialize",le="+Inf"} 1'
+    ) in text
+    assert 'endpoint="metrics"' not in text
+
+
+def test_fingerprint():
+    sql = "SELECT id FROM unit WHERE name = 'O''Brien' AND id IN (%s, %s,%s)  LIMIT 2"
+    assert fingerprint(sql) == (
+        "SELECT id FROM unit WHERE name = %s AND id IN (...) LIMIT %s"
+    )
+
+
+def test_query_budgets_large_army(data_for_mapgen, client):
+    data, *other = data_for_mapgen
+    data = copy.deepcopy(data)
+    UnitFactory.create_batch(200)
+    for index, dominion_id in enumerate(Unit.objects.values_list("dominion_id")):
+        data["units"].append(
+            {
+                "dominion_id": str(dominion_id[0]),
+                "for_nation": data["land_nation_1" if index % 2 else "land_nation_2"],
+                "quantity": "5",
+            }
+        )
+    url = reverse("v0:generate_map")
+    with check_query_budget(generate_map, "generate_map"):
+        assert client.post(url, data, content_type="application/json").status_code
+    for view, name in (
+        (AutocompleteUnitsView, "autocomplete_units_view"),
+        (AutocompleteNationsView, "autocomplete_nations_view"),
+    ):
+        with check_query_budget(view, name):
+            assert client.get(reverse("v0:" + name) + "?search=a&modded=1,2")
+
+
+def test_query_budget_exceeded(data_for_mapgen, client, settings, caplog):
+    data, *other = data_for_mapgen
+    url = reverse("v0:generate_map")
+    with mock.patch.object(generate_map, "query_budget", 1):
+        with pytest.raises(QueryBudgetExceeded) as error:
+            client.post(url, data, content_type="application/json")
+        assert str(error.value).startswith("v0:generate_map ran 4 queries, budget 1")
+        assert '1x SELECT "domdata_catalogversion"."version"' in str(error.value)
+        settings.QUERY_BUDGET_RAISE = False
+        invalidate_catalog()
+        assert client.post(url, data, content_type="application/json").status_code
+    assert "ran 4 queries, budget 1" in caplog.text
+
+
+def test_warmup_and_ready(client):
+    url = reverse("v0:ready")
+    assert client.get(url).status_code == 503
+    with mock.patch("apps.domdata.catalog.connections") as connections, mock.patch(
+        "apps.core.warmup._ready", False
+    ):
+        assert warmup()
+        connections.close_all.assert_called_once_with()
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.data == {"ready": True}
+        catalog = get_catalog()
+        assert ("units", (Unit.VANILLA,), False) in catalog._search_indexes
+    assert client.get(url).status_code == 503
+
+
+def test_warmup_failure_is_retried_by_ready(client, caplog):
+    url = reverse("v0:ready")
+    with mock.patch(
+        "apps.core.warmup.load_map_templates", side_effect=OSError("no templates")
+    ) as load, mock.patch("apps.core.warmup._failed_at", None):
+        assert not warmup()
+        assert "Warmup failed" in caplog.text
+        # Not retried before RETRY_INTERVAL.
+        assert client.get(url).status_code == 503
+        assert load.call_count == 1
+        with mock.patch("apps.core.warmup.RETRY_INTERVAL", 0):
+            assert client.get(url).status_code == 503
+            assert load.call_count == 2
+            load.side_effect = None
+            with mock.patch("apps.domdata.catalog.connections"), mock.patch(
+                "apps.core.warmup._ready", False
+            ):
+                assert client.get(url).status_code == 200
+                assert client.get(url).status_code == 200
+    assert load.call_count == 3
+    assert client.get(url).status_code == 503
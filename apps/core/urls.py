@@ -1,6 +1,17 @@
 from django.urls import path
 
-from apps.core.views import AutocompleteNationsView, AutocompleteUnitsView, generate_map
+from apps.core.views import (
+    AutocompleteNationsView,
+    AutocompleteUnitsView,
+    UnitStatsView,
+    generate_map,
+    map_base,
+    nation_definition,
+    nation_roster,
+    ready,
+    suggest_armies_view,
+    unit_definition,
+)
 
 urlpatterns = [
     path(
@@ -13,5 +24,20 @@ urlpatterns = [
         AutocompleteNationsView.as_view(),
         name="autocomplete_nations_view",
     ),
+    path("units/stats/", UnitStatsView.as_view(), name="unit_stats_view"),
+    path("nations/<int:dominion_id>/roster/", nation_roster, name="nation_roster"),
+    path(
+        "nations/<int:dominion_id>/definition/",
+        nation_definition,
+        name="nation_definition",
+    ),
+    path(
+        "units/<int:dominion_id>/definition/",
+        unit_definition,
+        name="unit_definition",
+    ),
+    path("armies/suggest/", suggest_armies_view, name="suggest_armies"),
     path("generate-map/", generate_map, name="generate_map"),
+    path("maps/<slug:name>.<slug:fingerprint>.map", map_base, name="map_base"),
+    path("ready/", ready, name="ready"),
 ]
@@ -1,48 +1,406 @@
-from rest_framework import filters
+import re
+
+from django.conf import settings
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseNotModified,
+    StreamingHttpResponse,
+)
+from django.urls import reverse
+from django.utils.cache import (
+    parse_etags,
+    patch_cache_control,
+    patch_vary_headers,
+    quote_etag,
+)
+from django.views.decorators.http import require_GET
+
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
 
+from apps.core.filters import CatalogSearchFilter, StatFilter
+from apps.core.mapcache import (
+    RENDER_VERSION,
+    canonical_key,
+    get_map,
+    set_map,
+    stream_into_cache,
+)
+from apps.core.maptemplates import MAP_NAMES, get_map_template
+from apps.core.metrics import render_metrics, timed
+from apps.core.pagination import CatalogPagination
+from apps.core.querybudget import query_budget
 from apps.core.serializers import (
+    ArmySerializer,
     GenerateMapSerializer,
     NationSerializer,
+    SuggestArmiesSerializer,
     UnitSerializer,
+    UnitStatsSerializer,
 )
-from apps.domdata.models import Nation, Unit
+from apps.core.warmup import is_ready, retry_warmup
+from apps.domdata.armies import UnbalanceableArmies, suggest_armies
+from apps.domdata.catalog import get_catalog, parse_mods
+from apps.domdata.modindex import MONSTER, NATION, find_definition
+from apps.domdata.stats import DEFAULT_STATS, get_stat_table
 
+# Checking the catalog version and building the catalog, views query nothing else.
+CATALOG_QUERIES = 4
 
-class AutocompleteUnitsView(ListAPIView):
-    serializer_class = UnitSerializer
-    filter_backends = [filters.SearchFilter]
-    search_fields = ["dominion_id", "name"]
+
+@query_budget(CATALOG_QUERIES)
+class CatalogListView(ListAPIView):
+    """List entries of one ``kind`` of the catalog for the ``?modded`` mod set."""
+
+    kind = None
+    filter_backends = [CatalogSearchFilter]
+    pagination_class = CatalogPagination
+
+    def get_kind(self):
+        return self.kind
+
+    def get_mods(self):
+        return parse_mods(self.request.GET.get("modded"))
 
     def get_queryset(self):
-        mods = self.request.GET.get("modded")
-        if mods:
-            mods_list = mods.split(",")
-            return Unit.objects.filter(modded__in=mods_list)
-        return Unit.objects.filter(modded=Unit.VANILLA)
+        return get_catalog().get_entries(self.get_kind(), self.get_mods())
+
+    def get_search_index(self, fuzzy=False):
+        return get_catalog().get_search_index(self.get_kind(), self.get_mods(), fuzzy)
+
+    def list(self, request, *args, **kwargs):
+        with timed("query"):
+            page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        with timed("serialize"):
+            data = self.get_serializer(page, many=True).data
+        return self.get_paginated_response(data)
+
+
+class AutocompleteUnitsView(CatalogListView):
+    """Units; ``?commander=1`` keeps only commanders and ``?commander=0`` troops."""
+
+    kind = "units"
+    serializer_class = UnitSerializer
 
+    def get_kind(self):
+        commander = self.request.GET.get("commander")
+        if commander in ("1", "true"):
+            return "commanders"
+        if commander in ("0", "false"):
+            return "troops"
+        return self.kind
 
-class AutocompleteNationsView(ListAPIView):
+
+class UnitStatsView(AutocompleteUnitsView):
+    """Units with their stats, filtered and ordered by stats, see ``StatFilter``.
+
+    ``?stats=hp,leader`` picks the stats returned with every unit.
+    """
+
+    filter_backends = [CatalogSearchFilter, StatFilter]
+    serializer_class = UnitStatsSerializer
+
+    def get_stats(self):
+        value = self.request.GET.get("stats")
+        if not value:
+            return DEFAULT_STATS
+        stats = [x for x in value.split(",") if x]
+        unknown = [x for x in stats if x not in get_stat_table().columns]
+        if unknown:
+            raise ValidationError(
+                {"stats": ["There is no such stat as {}".format(x) for x in unknown]}
+            )
+        return stats
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["stats"] = self.get_stats()
+        return context
+
+
+class AutocompleteNationsView(CatalogListView):
+    kind = "nations"
     serializer_class = NationSerializer
-    filter_backends = [filters.SearchFilter]
-    search_fields = ["dominion_id", "name"]
 
-    def get_queryset(self):
-        mods = self.request.GET.get("modded")
-        if mods:
-            mods_list = mods.split(",")
-            return Nation.objects.filter(modded__in=mods_list)
-        return Nation.objects.filter(modded=Nation.VANILLA)
+
+def not_modified(request, etag):
+    """Return a 304 response if the client already has ``etag``, else ``None``."""
+    if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+    return None
+
+
+@query_budget(CATALOG_QUERIES)
+@api_view(["GET"])
+def nation_roster(request, dominion_id):
+    """Return a nation with its recruitable commanders and troops.
+
+    The roster only changes with the catalog, so it is cacheable per nation and
+    ``?modded`` mod set: responses carry an ``ETag`` and ``Cache-Control``.
+    """
+    catalog = get_catalog()
+    nation = catalog.nations.get(dominion_id)
+    if nation is None:
+        raise Http404("There is no such nation with dominion_id {}".format(dominion_id))
+    mods = parse_mods(request.GET.get("modded"))
+    etag = quote_etag(
+        "{}.{}.{}".format(catalog.version, dominion_id, "-".join(map(str, mods)))
+    )
+    response = not_modified(request, etag)
+    if response is None:
+        commanders, troops = catalog.get_roster(dominion_id, mods)
+        response = Response(
+            {
+                "nation": NationSerializer(nation).data,
+                "commanders": UnitSerializer(commanders, many=True).data,
+                "troops": UnitSerializer(troops, many=True).data,
+            }
+        )
+        response["ETag"] = etag
+    patch_cache_control(response, max_age=settings.ROSTER_CACHE_MAX_AGE)
+    return response
+
+
+def definition_response(kind, entry, missing):
+    if entry is None:
+        raise Http404(missing)
+    definition = find_definition(kind, entry.dominion_id, entry.modded)
+    if definition is None:
+        raise Http404("There is no mod definition of {}".format(entry.name))
+    return Response(
+        {
+            "dominion_id": entry.dominion_id,
+            "name": entry.name,
+            "modded": entry.modded,
+            "definition": definition,
+        }
+    )
+
+
+@query_budget(CATALOG_QUERIES)
+@api_view(["GET"])
+def unit_definition(request, dominion_id):
+    """Return every ``#`` command of a modded unit, read lazily from its mod file."""
+    return definition_response(
+        MONSTER,
+        get_catalog().units.get(dominion_id),
+        "There is no such unit with dominion_id {}".format(dominion_id),
+    )
 
 
+@query_budget(CATALOG_QUERIES)
+@api_view(["GET"])
+def nation_definition(request, dominion_id):
+    """Return every ``#`` command of a modded nation, read lazily from its mod file."""
+    return definition_response(
+        NATION,
+        get_catalog().nations.get(dominion_id),
+        "There is no such nation with dominion_id {}".format(dominion_id),
+    )
+
+
+@query_budget(CATALOG_QUERIES)
+@api_view(["GET"])
+def suggest_armies_view(request):
+    """Suggest armies of two nations costing about the same ``?gold``.
+
+    ``?nation_1`` and ``?nation_2`` are dominion_ids, ``?resources`` optionally
+    caps the resource cost and ``?modded`` selects the units, like elsewhere.
+    A nation without an army within the budgets is a ``400`` on its field.
+    """
+    serializer = SuggestArmiesSerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+    data = serializer.validated_data
+    catalog = get_catalog()
+    nation_ids = (data["nation_1"], data["nation_2"])
+    try:
+        armies = suggest_armies(
+            nation_ids,
+            data["gold"],
+            data.get("resources"),
+            parse_mods(request.GET.get("modded")),
+        )
+    except UnbalanceableArmies as error:
+        field = "nation_{}".format(nation_ids.index(error.nation_id) + 1)
+        return Response({field: [str(error)]}, status=400)
+    return Response(
+        [
+            {
+                "nation": NationSerializer(catalog.nations[nation_id]).data,
+                "army": ArmySerializer(army).data,
+            }
+            for nation_id, army in zip(nation_ids, armies)
+        ]
+    )
+
+
+@api_view(["GET"])
+def ready(request):
+    """Readiness probe, ``503`` until templates, catalog and stats are loaded.
+
+    A failed warmup is retried here, see ``apps.core.warmup``.
+    """
+    if is_ready() or retry_warmup():
+        return Response({"ready": True})
+    return Response({"ready": False}, status=503)
+
+
+OUTPUT_JSON, OUTPUT_FILE, OUTPUT_SCENARIO = "json", "file", "scenario"
+# Base maps are addressed by the fingerprint of their content, so never change.
+BASE_MAP_MAX_AGE = 60 * 60 * 24 * 365
+ACCEPTS_GZIP = re.compile(r"\bgzip\b")
+
+
+def accepts_gzip(request):
+    return bool(ACCEPTS_GZIP.search(request.META.get("HTTP_ACCEPT_ENCODING", "")))
+
+
+@require_GET
+def map_base(request, name, fingerprint):
+    """Return a map template as is, for clients filling its slots themselves.
+
+    Clients accepting gzip get the template compressed when it was loaded.
+    """
+    if name not in MAP_NAMES:
+        raise Http404("There is no such map as {}".format(name))
+    template = get_map_template(name)
+    if fingerprint != template.fingerprint:
+        raise Http404("There is no such version of {}".format(name))
+    compress = accepts_gzip(request)
+    etag = quote_etag(template.fingerprint + (".gz" if compress else ""))
+    response = not_modified(request, etag)
+    if response is None:
+        response = HttpResponse(
+            template.gzip_source if compress else template.source,
+            content_type="text/plain; charset=utf-8",
+        )
+        if compress:
+            response["Content-Encoding"] = "gzip"
+        response["ETag"] = etag
+    patch_vary_headers(response, ("Accept-Encoding",))
+    patch_cache_control(response, public=True, max_age=BASE_MAP_MAX_AGE, immutable=True)
+    return response
+
+
+def map_file_response(serializer, content, compress=False):
+    response = StreamingHttpResponse(content, content_type="text/plain; charset=utf-8")
+    response["Content-Disposition"] = 'attachment; filename="{}"'.format(
+        serializer.get_filename()
+    )
+    if compress:
+        response["Content-Encoding"] = "gzip"
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+def scenario_response(serializer):
+    """Return the slot values of the map and the URL of the base map to fill."""
+    with timed("process_data"):
+        returned_data = serializer.process_data(serializer.validated_data)
+    with timed("data_into_map"):
+        scenario = serializer.data_into_map(returned_data)
+    template = get_map_template(serializer.map_name)
+    base = reverse("v0:map_base", args=(template.name, template.fingerprint))
+    return Response({"base": base, "context": serializer.get_context(scenario)})
+
+
+def render_map(serializer, compress=False):
+    with timed("process_data"):
+        returned_data = serializer.process_data(serializer.validated_data)
+    with timed("data_into_map"):
+        mapgenerated_text = serializer.data_into_map(returned_data)
+    with timed("substitute"):
+        return serializer.stream(mapgenerated_text, compress)
+
+
+@query_budget(CATALOG_QUERIES)
 @api_view(["POST"])
 def generate_map(request):
+    """Generate the arena map.
+
+    By default the map is returned as a JSON string. With ``?output=file`` it is
+    sent as a plain text attachment built from the pre-encoded template chunks,
+    gzip encoded from the precompressed chunks for clients accepting gzip.
+
+    With ``?summary=1`` the JSON response is ``{"map": ..., "summary": ...}``,
+    the summary giving the costs, hit points and leadership of every army. Gold
+    costs the game computes are estimated, flagged by ``gold_is_estimate``.
+
+    With ``?output=scenario`` only the generated part is returned, as
+    ``{"base": ..., "context": ...}``: ``context`` holds the values of the
+    ``$name`` slots of the map template served at ``base``. That template is the
+    same for every request and cached by clients for good.
+
+    Rendered maps are cached by a hash of the canonicalized request, which is
+    also used as a strong ``ETag`` so repeated matchups can be answered with 304.
+    Files are streamed as they render and cached once the last chunk was sent.
+    """
     serializer = GenerateMapSerializer(data=request.data)
-    if serializer.is_valid():
-        returned_data = serializer.process_data(serializer.validated_data)
-        mapgenerated_text = serializer.data_into_map(returned_data)
-        final_map = serializer.substitute(mapgenerated_text)
-        return Response(final_map, status=200)
-    return Response(serializer.errors, status=400)
+    with timed("is_valid"):
+        valid = serializer.is_valid()
+    if not valid:
+        return Response(serializer.errors, status=400)
+    output = request.query_params.get("output", OUTPUT_JSON)
+    summary = request.query_params.get("summary") in ("1", "true")
+    summary = summary and output == OUTPUT_JSON
+    template = get_map_template(serializer.map_name)
+    key = canonical_key(
+        serializer.canonical_payload(),
+        [get_catalog().version, template.fingerprint, RENDER_VERSION],
+    )
+    compress = output == OUTPUT_FILE and accepts_gzip(request)
+    etag = quote_etag(
+        "{}.{}{}{}".format(
+            key, output, ".summary" if summary else "", ".gz" if compress else ""
+        )
+    )
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    if output == OUTPUT_SCENARIO:
+        response = scenario_response(serializer)
+        response["ETag"] = etag
+        return response
+    if compress:
+        # Cheaper than compressing a cached map: only slot values get compressed.
+        response = map_file_response(serializer, render_map(serializer, True), True)
+        response["ETag"] = etag
+        return response
+    content = get_map(key)
+    if content is None:
+        if output == OUTPUT_FILE:
+            chunks = render_map(serializer)
+            if settings.MAP_CACHE_MAX_BYTES:
+                chunks = stream_into_cache(key, chunks)
+            response = map_file_response(serializer, chunks)
+            response["ETag"] = etag
+            return response
+        content = render_map(serializer)
+        with timed("join"):
+            content = b"".join(content)
+        set_map(key, content)
+    if output == OUTPUT_FILE:
+        response = map_file_response(serializer, [content])
+    elif summary:
+        with timed("summary"):
+            army_summary = serializer.get_summary(
+                serializer.process_data(serializer.validated_data)
+            )
+        response = Response({"map": content.decode(), "summary": army_summary})
+    else:
+        response = Response(content.decode(), status=200)
+    response["ETag"] = etag
+    return response
+
+
+def metrics(request):
+    """Return the stage timings of this worker in the Prometheus text format."""
+    return HttpResponse(
+        render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
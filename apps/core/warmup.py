@@ -0,0 +1,70 @@
+"""Loading of everything requests need before workers are forked.
+
+``conf/wsgi.py`` calls :func:`warmup` at import, which ``gunicorn --preload``
+does once in the master process. The map templates, the Nation/Unit catalog
+with the search indexes of the default mod set, the unit stats and the offsets
+of the mod files are then shared copy-on-write by every worker, and no request
+pays for loading them. ``conf/gunicorn.py`` freezes these objects out of the
+garbage collector before forking, so collections do not touch their pages.
+
+A failed warmup, like one without a database, is logged and does not stop the
+server: the process is not ready, every forked worker warms up again and the
+readiness endpoint retries every ``RETRY_INTERVAL`` seconds. It reports
+healthy once a warmup succeeded in the process answering it.
+"""
+import logging
+import time
+
+from apps.core.maptemplates import load_map_templates
+from apps.domdata.catalog import preload_catalog
+from apps.domdata.modindex import get_mod_files, get_mod_index
+from apps.domdata.models import Unit
+from apps.domdata.stats import get_stat_table
+
+logger = logging.getLogger(__name__)
+
+SEARCH_KINDS = ("nations", "units")
+# Seconds between retries of a failed warmup by the readiness endpoint.
+RETRY_INTERVAL = 10
+
+_ready = False
+_failed_at = None
+
+
+def is_ready():
+    return _ready
+
+
+def warmup():
+    """Load templates, catalog, stats and mod indexes, then mark the process ready.
+
+    Returns whether it succeeded, errors are logged.
+    """
+    global _ready, _failed_at
+    start = time.perf_counter()
+    try:
+        load_map_templates()
+        # Closes the DB connections, forked workers must open their own.
+        catalog = preload_catalog()
+        for kind in SEARCH_KINDS:
+            catalog.get_search_index(kind, (Unit.VANILLA,))
+        get_stat_table()
+        for filename in get_mod_files():
+            get_mod_index(filename)
+    except Exception:
+        _failed_at = time.monotonic()
+        logger.exception("Warmup failed, the process is not ready")
+        return False
+    _ready, _failed_at = True, None
+    logger.info("Warmup finished in %.2fs", time.perf_counter() - start)
+    return True
+
+
+def retry_warmup():
+    """Warm up again if the last warmup failed ``RETRY_INTERVAL`` seconds ago.
+
+    Returns whether the process is ready.
+    """
+    if _failed_at is not None and time.monotonic() - _failed_at >= RETRY_INTERVAL:
+        warmup()
+    return _ready
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import Nation, Unit
+from .models import ImportSource, Nation, Unit
 
 admin.site.register(Nation)
 admin.site.register(Unit)
+admin.site.register(ImportSource)
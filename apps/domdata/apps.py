@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class DomdataConfig(AppConfig):
     name = "apps.domdata"
+
+    def ready(self):
+        from apps.domdata import signals  # noqa: F401
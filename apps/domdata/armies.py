@@ -0,0 +1,266 @@
+"""Suggestions of armies of equal cost for two nations.
+
+Every side starts from a greedy army: the commander with the best leadership
+it can afford with a share of the gold, filled with the troops giving most
+hit points per gold. A local search then moves quantities of commanders and
+troops up and down, within ``MAX_COMMANDER_TYPES`` commander and
+``MAX_TROOP_TYPES`` troop types and the leadership of the commanders, while
+that brings the gold spent closer to the budget, or keeps it and adds hit
+points. Every search tries a fixed number of moves. The side that spent more
+is then searched again with the gold the other side spent, until both armies
+cost the same; after ``MAX_BALANCING_ROUNDS`` the closest armies built are kept.
+Costs are the ``gcost_estimate`` of the stats, the game's cost of most units
+is not known. :class:`UnbalanceableArmies` is raised when a nation cannot
+field an army within the gold, rather than suggesting an empty one.
+
+The search is seeded from its inputs and bounded by a move count, not time, so
+a suggestion only depends on the nations, budgets, mods and catalog version:
+every worker computes the same armies, and caches them in its own memory.
+"""
+import math
+import random
+from collections import namedtuple
+from functools import lru_cache
+from itertools import product
+
+from django.conf import settings
+
+from apps.domdata.catalog import get_catalog
+from apps.domdata.stats import get_stat_table
+
+Candidate = namedtuple(
+    "Candidate", ["dominion_id", "name", "gold", "resources", "hp", "leader"]
+)
+Army = namedtuple(
+    "Army", ["commanders", "troops", "gold", "resources", "hp", "leadership"]
+)
+
+COMMANDER_SHARE = 0.25
+MAX_COMMANDER_TYPES = 2
+MAX_TROOP_TYPES = 3
+MAX_STALLED = 2000
+MAX_BALANCING_ROUNDS = 8
+CANDIDATE_STATS = ("gcost_estimate", "rcost", "hp", "leader")
+
+
+class UnbalanceableArmies(ValueError):
+    """No army of ``nation_id`` fits the budgets."""
+
+    def __init__(self, nation_id, message):
+        super().__init__(message)
+        self.nation_id = nation_id
+
+
+def get_candidates(units):
+    """Return the units which have stats and a gold cost, as ``Candidate``."""
+    table = get_stat_table()
+    candidates = []
+    for unit in units:
+        stats = table.get_row(unit.dominion_id, CANDIDATE_STATS)
+        if stats and stats["gcost_estimate"]:
+            candidates.append(
+                Candidate(unit.dominion_id, unit.name, *map(stats.get, CANDIDATE_STATS))
+            )
+    return candidates
+
+
+def pick_commander(commanders, gold, resources):
+    """Return the commander leading most within the commander share, or the cheapest."""
+    affordable = [
+        x
+        for x in commanders
+        if x.gold <= gold * COMMANDER_SHARE and x.resources <= resources
+    ]
+    if affordable:
+        return max(affordable, key=lambda x: (x.leader, -x.gold, -x.dominion_id))
+    cheapest = min(commanders, key=lambda x: (x.gold, x.dominion_id), default=None)
+    if cheapest is None or cheapest.gold > gold or cheapest.resources > resources:
+        return None
+    return cheapest
+
+
+class ArmySearch:
+    """Local search of commander and troop quantities within the budgets.
+
+    Quantities are kept by index in ``units``, commanders first. An army is
+    feasible when it has a commander, stays within gold and resources and its
+    troops do not exceed the leadership of its commanders.
+    """
+
+    def __init__(self, commanders, troops, gold, resources, rng):
+        self.units = commanders + troops
+        self.commander_count = len(commanders)
+        self.gold, self.resources = gold, resources
+        self.rng = rng
+
+    def is_commander(self, index):
+        return index < self.commander_count
+
+    def totals(self, quantities):
+        gold = resources = hp = leadership = troops = 0
+        for index, quantity in quantities.items():
+            unit = self.units[index]
+            gold += unit.gold * quantity
+            resources += unit.resources * quantity
+            hp += unit.hp * quantity
+            if self.is_commander(index):
+                leadership += unit.leader * quantity
+            else:
+                troops += quantity
+        return gold, resources, hp, leadership, troops
+
+    def score(self, quantities):
+        """Return a sortable score, lower is better, or ``None`` if infeasible."""
+        gold, resources, hp, leadership, troops = self.totals(quantities)
+        commander_types = sum(map(self.is_commander, quantities))
+        if (
+            not commander_types
+            or commander_types > MAX_COMMANDER_TYPES
+            or len(quantities) - commander_types > MAX_TROOP_TYPES
+            or gold > self.gold
+            or resources > self.resources
+            or troops > leadership
+        ):
+            return None
+        return self.gold - gold, -hp
+
+    def greedy(self):
+        """Take one commander, then the troops giving most hit points per gold."""
+        commander = pick_commander(
+            self.units[: self.commander_count], self.gold, self.resources
+        )
+        if commander is None:
+            return {}
+        quantities = {self.units.index(commander): 1}
+        gold, resources, hp, leadership, count = self.totals(quantities)
+        order = sorted(
+            range(self.commander_count, len(self.units)),
+            key=lambda x: (-self.units[x].hp / self.units[x].gold, x),
+        )
+        for index in order[:MAX_TROOP_TYPES]:
+            troop = self.units[index]
+            limits = [(self.gold - gold) // troop.gold, leadership - count]
+            if troop.resources > 0 and self.resources != math.inf:
+                limits.append((self.resources - resources) // troop.resources)
+            quantity = min(limits)
+            if quantity > 0:
+                quantities[index] = quantity
+                gold += troop.gold * quantity
+                resources += troop.resources * quantity
+                count += quantity
+        return quantities
+
+    def neighbour(self, quantities):
+        quantities = dict(quantities)
+        if self.rng.random() < 0.3:
+            index = self.rng.randrange(len(self.units))
+        else:
+            index = self.rng.choice(list(quantities))
+        step = self.rng.choice((1, 1, 2, 5))
+        quantity = quantities.get(index, 0) + self.rng.choice((-step, step))
+        if quantity > 0:
+            quantities[index] = quantity
+        else:
+            quantities.pop(index, None)
+        return quantities
+
+    def run(self, iterations):
+        """Improve the greedy army until the gold is spent, ``iterations`` moves
+        were tried or ``MAX_STALLED`` moves in a row bring nothing."""
+        best = self.greedy()
+        best_score = self.score(best)
+        stalled = 0
+        for _ in range(iterations):
+            if not best_score or best_score[0] <= 0 or stalled >= MAX_STALLED:
+                break
+            candidate = self.neighbour(best)
+            candidate_score = self.score(candidate)
+            if candidate_score is not None and candidate_score <= best_score:
+                stalled = 0 if candidate_score < best_score else stalled + 1
+                best, best_score = candidate, candidate_score
+            else:
+                stalled += 1
+        return best
+
+
+def build_army(commanders, troops, gold, resources, rng, iterations):
+    search = ArmySearch(commanders, troops, gold, resources, rng)
+    quantities = search.run(iterations)
+    gold, resources, hp, leadership, _ = search.totals(quantities)
+    chosen = sorted(quantities.items())
+    return Army(
+        [(search.units[x], y) for x, y in chosen if search.is_commander(x)],
+        [(search.units[x], y) for x, y in chosen if not search.is_commander(x)],
+        gold,
+        resources,
+        hp,
+        leadership,
+    )
+
+
+def check_armies(nation_ids, armies, gold):
+    for nation_id, army in zip(nation_ids, armies):
+        if not army.commanders:
+            raise UnbalanceableArmies(
+                nation_id,
+                "Nation {} has no army within {} gold".format(nation_id, gold),
+            )
+
+
+@lru_cache(maxsize=256)
+def _suggest(version, nation_ids, gold, resources, mods, iterations):
+    catalog = get_catalog()
+    rng = random.Random(repr((version, nation_ids, gold, resources, mods)))
+    sides = []
+    for nation_id in nation_ids:
+        commanders, troops = map(get_candidates, catalog.get_roster(nation_id, mods))
+        if not commanders or not troops:
+            raise UnbalanceableArmies(
+                nation_id, "Nation {} has no commanders and troops".format(nation_id)
+            )
+        sides.append((commanders, troops))
+    armies = [build_army(*side, gold, resources, rng, iterations) for side in sides]
+    check_armies(nation_ids, armies, gold)
+    built = [[x] for x in armies]
+    # Every rebuild spends at most the gold of the poorest army, so the costs
+    # only go down and usually meet within a round or two. When they keep
+    # missing each other, the closest armies built are suggested.
+    for _ in range(MAX_BALANCING_ROUNDS):
+        richest = max(range(len(armies)), key=lambda x: (armies[x].gold, -x))
+        poorest = min(armies, key=lambda x: x.gold)
+        if armies[richest].gold == poorest.gold:
+            return tuple(armies)
+        armies[richest] = build_army(
+            *sides[richest], poorest.gold, resources, rng, iterations
+        )
+        check_armies(nation_ids, armies, poorest.gold)
+        built[richest].append(armies[richest])
+    return min(
+        product(*built),
+        key=lambda x: (
+            max(y.gold for y in x) - min(y.gold for y in x),
+            -min(y.gold for y in x),
+        ),
+    )
+
+
+def suggest_armies(nation_ids, gold, resources=None, mods=(1,), iterations=None):
+    """Return an ``Army`` per nation of ``nation_ids``, each costing about ``gold``.
+
+    ``resources`` caps the resource cost of every army when given. Every search
+    tries at most ``iterations`` moves, ``ARMY_SUGGESTION_ITERATIONS`` by
+    default. Results are cached per catalog version, nations, budgets and mods.
+    Raises :class:`UnbalanceableArmies` if a nation has no army within them.
+    """
+    catalog = get_catalog()
+    if resources is None:
+        resources = math.inf
+    if iterations is None:
+        iterations = settings.ARMY_SUGGESTION_ITERATIONS
+    return _suggest(
+        catalog.version, tuple(nation_ids), gold, resources, tuple(mods), iterations
+    )
+
+
+def clear_suggestions():
+    _suggest.cache_clear()
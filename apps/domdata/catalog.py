@@ -0,0 +1,255 @@
+"""Read-only, in-memory snapshot of the Nation and Unit tables.
+
+The data is only written by ``parse_data``, so every worker builds the catalog
+once (before forking when gunicorn runs with ``--preload``) and serves lookups
+from memory. The snapshot carries the :class:`CatalogVersion` it was built
+from; workers check that version at most every ``CATALOG_CHECK_INTERVAL``
+seconds and rebuild the catalog after a re-import.
+
+The importer bumps the version in the transaction writing the data, so a
+version always matches complete data. A worker noticing a new version keeps
+serving its current snapshot while the next one is built in a background
+thread, then swaps them; the old snapshot is freed once no request uses it.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from types import MappingProxyType
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+
+from apps.domdata.models import CatalogVersion, Nation, Unit
+from apps.domdata.search import FuzzyIndex, NgramIndex
+
+logger = logging.getLogger(__name__)
+
+ERA_DISPLAY = dict(Nation.ERA_CHOICES)
+MODS = frozenset(mod for mod, _ in Unit.CHOICES)
+
+
+class NationEntry(namedtuple("NationEntry", ["dominion_id", "name", "era", "modded"])):
+    __slots__ = ()
+
+    def get_era_display(self):
+        return ERA_DISPLAY[self.era]
+
+
+UnitEntry = namedtuple(
+    "UnitEntry", ["dominion_id", "name", "commander", "modded", "nations"]
+)
+
+
+@contextmanager
+def snapshot():
+    """Run the queries of the block on one consistent view of the data.
+
+    Postgres reads each statement of a READ COMMITTED transaction from the
+    latest commit, so the outermost transaction is made REPEATABLE READ. SQLite
+    transactions already read from one snapshot.
+    """
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        yield
+
+
+def parse_mods(value):
+    """Turn a ``?modded=1,2`` query value into a tuple of mod ids.
+
+    Unknown mods are dropped, so there are only as many mod sets, and search
+    indexes kept per mod set, as combinations of the known mods.
+    """
+    mods = set()
+    for mod in (value or "").split(","):
+        try:
+            mods.add(int(mod))
+        except ValueError:
+            continue
+    return tuple(sorted(mods & MODS)) or (Unit.VANILLA,)
+
+
+class Catalog:
+    """Immutable indexes over nations and units.
+
+    - ``nations`` and ``units`` map dominion_id to entries;
+    - ``nations_by_key`` maps ``(era, name, modded)`` to a nation;
+    - ``nations_by_mod`` and ``units_by_mod`` keep entries in table order;
+    - every unit entry holds the dominion_ids of the nations recruiting it and
+      ``rosters`` maps a nation dominion_id to the units it recruits.
+
+    Search indexes are built lazily per kind and mod set and kept with the
+    catalog, so they are dropped together with it after a re-import.
+    """
+
+    def __init__(self, version, nations, units):
+        self.version = version
+        self.nations = MappingProxyType({x.dominion_id: x for x in nations})
+        self.units = MappingProxyType({x.dominion_id: x for x in units})
+        self.nations_by_key = MappingProxyType(
+            {(x.era, x.name, x.modded): x for x in nations}
+        )
+        self.nations_by_name = MappingProxyType(
+            {(x.era, x.name): x for x in reversed(nations)}
+        )
+        self.nations_by_mod = self._group_by_mod(nations)
+        self.units_by_mod = self._group_by_mod(units)
+        rosters = {}
+        for unit in units:
+            for nation_id in unit.nations:
+                rosters.setdefault(nation_id, []).append(unit)
+        self.rosters = MappingProxyType({x: tuple(y) for x, y in rosters.items()})
+        self._search_indexes = {}
+
+    @staticmethod
+    def _group_by_mod(entries):
+        grouped = {}
+        for entry in entries:
+            grouped.setdefault(entry.modded, []).append(entry)
+        return MappingProxyType({mod: tuple(x) for mod, x in grouped.items()})
+
+    @classmethod
+    def build(cls):
+        """Read the version and the tables in one snapshot, see :func:`snapshot`.
+
+        An import committing meanwhile could otherwise mix two generations of
+        data under one version.
+        """
+        with snapshot():
+            return cls._build()
+
+    @classmethod
+    def _build(cls):
+        version = CatalogVersion.get_current()
+        nations, nation_ids = [], {}
+        for pk, *fields in Nation.objects.order_by("pk").values_list(
+            "pk", "dominion_id", "name", "era", "modded"
+        ):
+            nations.append(NationEntry(*fields))
+            nation_ids[pk] = fields[0]
+        unit_nations = {}
+        for unit_pk, nation_pk in Unit.nations.through.objects.values_list(
+            "unit_id", "nation_id"
+        ):
+            unit_nations.setdefault(unit_pk, []).append(nation_ids[nation_pk])
+        units = [
+            UnitEntry(*fields, tuple(sorted(unit_nations.get(pk, ()))))
+            for pk, *fields in Unit.objects.order_by("pk").values_list(
+                "pk", "dominion_id", "name", "commander", "modded"
+            )
+        ]
+        return cls(version, nations, units)
+
+    def find_nation(self, era, name, modded=None):
+        if modded is None:
+            return self.nations_by_name.get((era, name))
+        return self.nations_by_key.get((era, name, modded))
+
+    def get_nations(self, mods):
+        return [x for mod in mods for x in self.nations_by_mod.get(mod, ())]
+
+    def get_units(self, mods):
+        return [x for mod in mods for x in self.units_by_mod.get(mod, ())]
+
+    def get_roster(self, nation_id, mods):
+        """Split the units of a nation found in ``mods`` into commanders and troops."""
+        commanders, troops = [], []
+        for unit in self.rosters.get(nation_id, ()):
+            if unit.modded in mods:
+                (commanders if unit.commander else troops).append(unit)
+        return commanders, troops
+
+    def get_entries(self, kind, mods):
+        """Return ``"nations"``, ``"units"``, ``"commanders"`` or ``"troops"``."""
+        if kind == "nations":
+            return self.get_nations(mods)
+        units = self.get_units(mods)
+        if kind == "commanders":
+            return [x for x in units if x.commander]
+        if kind == "troops":
+            return [x for x in units if not x.commander]
+        return units
+
+    def get_search_index(self, kind, mods, fuzzy=False):
+        """Return the search index of one kind of entries for a mod set.
+
+        ``fuzzy`` selects the typo tolerant ``FuzzyIndex`` built on top of the
+        exact ``NgramIndex``.
+        """
+        key = (kind, mods, fuzzy)
+        index = self._search_indexes.get(key)
+        if index is None:
+            if fuzzy:
+                index = FuzzyIndex(self.get_search_index(kind, mods))
+            else:
+                index = NgramIndex(self.get_entries(kind, mods))
+            index = self._search_indexes.setdefault(key, index)
+        return index
+
+
+_catalog = None
+_checked_at = 0.0
+_rebuilding = None
+_lock = threading.Lock()
+
+
+def rebuild_catalog(version):
+    """Build the catalog of ``version`` and swap it in unless a newer one is there."""
+    global _catalog, _rebuilding
+    try:
+        catalog = Catalog.build()
+        with _lock:
+            if _catalog is None or _catalog.version != catalog.version:
+                _catalog = catalog
+    except Exception:
+        logger.exception("Could not rebuild the catalog of version %s", version)
+    finally:
+        _rebuilding = None
+        connections.close_all()
+
+
+def get_catalog():
+    """Return the current catalog, rebuilding it if the data was re-imported.
+
+    Only the first build blocks; later rebuilds run in the background when
+    ``CATALOG_BACKGROUND_REBUILD`` is set and the previous catalog is returned
+    until the new one is ready.
+    """
+    global _catalog, _checked_at, _rebuilding
+    catalog, now = _catalog, time.monotonic()
+    if catalog is not None and now - _checked_at < settings.CATALOG_CHECK_INTERVAL:
+        return catalog
+    with _lock:
+        _checked_at = now
+        if _catalog is None:
+            _catalog = Catalog.build()
+            return _catalog
+        version = CatalogVersion.get_current()
+        if _catalog.version != version:
+            if not settings.CATALOG_BACKGROUND_REBUILD:
+                _catalog = Catalog.build()
+            elif _rebuilding is None:
+                _rebuilding = threading.Thread(
+                    target=rebuild_catalog, args=(version,), daemon=True
+                )
+                _rebuilding.start()
+        return _catalog
+
+
+def invalidate_catalog():
+    global _catalog
+    _catalog = None
+
+
+def preload_catalog():
+    """Build the catalog in the master process and drop its DB connections.
+
+    Connections must not be shared with forked workers, they open their own.
+    """
+    catalog = get_catalog()
+    connections.close_all()
+    return catalog
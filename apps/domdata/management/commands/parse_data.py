@@ -2,14 +2,43 @@ import sys
 
 from django.core.management.base import BaseCommand
 
-from apps.domdata.parser import parse_dm_files, parse_units
+from apps.domdata.parser import import_data
 
 
 class Command(BaseCommand):
     help = "Parse data inside the DB"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Import every source even if none of them changed",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            help="Number of processes parsing mod files, defaults to the CPU count",
+        )
+
     def handle(self, *args, **options):
         sys.stdout.write("Start parsing \n")
-        parse_units()
-        parse_dm_files()
-        sys.stdout.write("Parsing finished \n")
+        timings = []
+        imported, diffs = import_data(
+            timings, force=options["force"], workers=options["workers"]
+        )
+        if not imported:
+            sys.stdout.write("Data unchanged, nothing to import \n")
+            return
+        for filename in imported:
+            sys.stdout.write("Imported {} \n".format(filename))
+        for table, (created, updated, deleted) in diffs.items():
+            sys.stdout.write(
+                "{:<20} {} created, {} updated, {} deleted\n".format(
+                    table, created, updated, deleted
+                )
+            )
+        for name, seconds in timings:
+            sys.stdout.write("{:<20} {:8.2f}s\n".format(name, seconds))
+        sys.stdout.write(
+            "Parsing finished in {:.2f}s \n".format(sum(x[1] for x in timings))
+        )
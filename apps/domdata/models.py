@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
 
 
 class BaseModel(models.Model):
@@ -35,3 +37,42 @@ class Unit(BaseModel):
     dominion_id = models.PositiveIntegerField(db_index=True, unique=True)
     commander = models.BooleanField(default=False)
     nations = models.ManyToManyField(Nation)
+
+
+class CatalogVersion(models.Model):
+    """Single row counter bumped whenever Nation or Unit data changes.
+
+    Workers compare it with the version of their in-memory catalog to know when
+    the catalog has to be rebuilt.
+    """
+
+    version = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.version}"
+
+    @classmethod
+    def get_current(cls):
+        return cls.objects.values_list("version", flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.update(version=F("version") + 1, updated=timezone.now()):
+            cls.objects.create(version=1)
+
+
+class ImportSource(models.Model):
+    """Manifest entry of a csv dump or mod file imported by ``parse_data``.
+
+    ``path`` is relative to the domdata app, ``rows`` counts the rows or mod
+    entries read from the file when it was last imported.
+    """
+
+    path = models.CharField(max_length=256, unique=True)
+    sha256 = models.CharField(max_length=64)
+    rows = models.PositiveIntegerField(default=0)
+    imported_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.path}"
@@ -0,0 +1,147 @@
+"""Lazy access to full monster and nation definitions of mod files.
+
+Only names make it to the database. The other ``#`` commands of a definition
+are read on demand: a ``ModIndex`` records the byte offset and length of every
+``#newmonster`` and ``#selectnation`` ... ``#end`` block of a mod file in one
+pass, then lookups slice the memory-mapped file and parse that block only.
+Parsed blocks are kept in a small LRU.
+"""
+import mmap
+import os
+import re
+import threading
+from functools import lru_cache
+
+from apps.domdata.parser import CURRENT_DIR, get_dm_files, get_mod
+
+MONSTER, NATION = "monster", "nation"
+BLOCK_STARTS = ((b"#newmonster", MONSTER), (b"#selectnation", NATION))
+NUMBER = re.compile(rb"\d+")
+PARSED_BLOCKS_CACHE_SIZE = 256
+
+
+def build_offsets(lines):
+    """Map ``(kind, dominion_id)`` to the ``(offset, length)`` of its block.
+
+    ``lines`` are the lines of a mod file as bytes. Blocks are delimited like
+    the tokenizer of the importer does: comment lines are skipped and a later
+    block of the same monster or nation replaces an earlier one.
+    """
+    offsets, current, position = {}, None, 0
+    for line in lines:
+        start, position = position, position + len(line)
+        if line.startswith(b"--"):
+            continue
+        for command, kind in BLOCK_STARTS:
+            if command in line:
+                current = (kind, int(NUMBER.search(line).group()), start)
+                break
+        else:
+            if b"#end" in line and current is not None:
+                kind, dominion_id, offset = current
+                offsets[(kind, dominion_id)] = (offset, position - offset)
+                current = None
+    return offsets
+
+
+def parse_block(text):
+    """Return the ``(command, value)`` pairs of a block in file order.
+
+    Quotes around a value are removed, commands without value get ``""``. A
+    quoted value, like a ``#descr``, runs until its closing quote, over as many
+    lines as it takes; they are joined with newlines.
+    """
+    definition, command, lines = [], None, None
+    for line in text.splitlines():
+        if lines is not None:
+            head, quote, _ = line.partition('"')
+            lines.append(head)
+            if quote:
+                definition.append((command, "\n".join(lines)))
+                lines = None
+            continue
+        line = line.strip()
+        if not line.startswith("#"):
+            continue
+        command, _, value = line.partition(" ")
+        value = value.strip()
+        if value.startswith('"'):
+            head, quote, _ = value[1:].partition('"')
+            if not quote:
+                lines = [head]
+                continue
+            value = head
+        definition.append((command, value))
+    if lines is not None:
+        definition.append((command, "\n".join(lines)))
+    return tuple(definition)
+
+
+class ModIndex:
+    """Offsets of the definitions of one mod file, see :func:`build_offsets`."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = os.path.join(CURRENT_DIR, filename)
+        with open(self.path, "rb") as mod_file:
+            self.offsets = build_offsets(mod_file)
+            self._map = mmap.mmap(mod_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get_text(self, kind, dominion_id):
+        start, length = self.offsets[(kind, dominion_id)]
+        end = start + length
+        return self._map[start:end].decode()
+
+    def get_definition(self, kind, dominion_id):
+        """Return the parsed block of a monster or nation, ``KeyError`` if none."""
+        return _parse_cached(self, kind, dominion_id)
+
+
+@lru_cache(maxsize=PARSED_BLOCKS_CACHE_SIZE)
+def _parse_cached(index, kind, dominion_id):
+    return parse_block(index.get_text(kind, dominion_id))
+
+
+_indexes = {}
+_dm_files = None
+_lock = threading.Lock()
+
+
+def get_mod_index(filename):
+    index = _indexes.get(filename)
+    if index is None:
+        with _lock:
+            index = _indexes.get(filename)
+            if index is None:
+                index = _indexes[filename] = ModIndex(filename)
+    return index
+
+
+def get_mod_files():
+    """Return the mod files, listed once like their indexes are built once."""
+    global _dm_files
+    if _dm_files is None:
+        with _lock:
+            if _dm_files is None:
+                _dm_files = tuple(get_dm_files())
+    return _dm_files
+
+
+def find_definition(kind, dominion_id, mod):
+    """Return the definition of a monster or nation of ``mod``, or ``None``.
+
+    Mod files are searched from the highest precedence down, like the
+    importer resolves a dominion_id defined by several mods.
+    """
+    for filename in reversed(get_mod_files()):
+        if get_mod(filename) == mod:
+            index = get_mod_index(filename)
+            if (kind, dominion_id) in index:
+                return index.get_definition(kind, dominion_id)
+    return None
@@ -1,139 +1,366 @@
 import csv
 import glob
+import hashlib
 import os
 import re
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
-from apps.domdata.models import Nation, Unit
-
-
-def parse_units():
-    Unit.objects.all().delete()
-    Nation.objects.all().delete()
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    with open(os.path.join(current_dir, "csvs/BaseU.csv"), "r", newline="") as csv_file:
-        reader = csv.DictReader(csv_file, delimiter="\t")
-        unit_list = []
-        for row in reader:
-            unit_list.append(Unit(name=row["name"], dominion_id=row["id"]))
-        Unit.objects.bulk_create(unit_list)
-    with open(
-        os.path.join(current_dir, "csvs/nations.csv"), "r", newline=""
-    ) as csv_file:
-        reader = csv.DictReader(csv_file, delimiter="\t")
-        nations_list = []
-        for row in reader:
-            nations_list.append(
-                Nation(name=row["name"], dominion_id=row["id"], era=row["era"])
-            )
-        Nation.objects.bulk_create(nations_list)
-    leader_types_files = [
-        "csvs/coast_leader_types_by_nation.csv",
-        "csvs/fort_leader_types_by_nation.csv",
-        "csvs/nonfort_leader_types_by_nation.csv",
-    ]
-    for filename in leader_types_files:
-        with open(os.path.join(current_dir, filename), "r", newline="") as csv_file:
-            reader = csv.DictReader(csv_file, delimiter="\t")
-            for row in reader:
-                nation = Nation.objects.get(dominion_id=row["nation_number"])
-                unit = Unit.objects.get(dominion_id=row["monster_number"])
-                unit.commander = True
-                unit.nations.add(nation)
-                unit.save(update_fields=["commander"])
-
-    troop_types_files = [
-        "csvs/coast_troop_types_by_nation.csv",
-        "csvs/fort_troop_types_by_nation.csv",
-        "csvs/nonfort_troop_types_by_nation.csv",
-    ]
-    for filename in troop_types_files:
-        with open(os.path.join(current_dir, filename), "r", newline="") as csv_file:
-            reader = csv.DictReader(csv_file, delimiter="\t")
-            for row in reader:
-                nation = Nation.objects.get(dominion_id=row["nation_number"])
-                unit = Unit.objects.get(dominion_id=row["monster_number"])
-                unit.nations.add(nation)
-
-    special_troop_file = "csvs/attributes_by_nation.csv"
-    # some magic numbers, that I've gotten from searching source of the modinspector
-    commander_attributes_numbers = [
-        158,
-        159,
-        163,
-        186,
-        295,
-        297,
-        299,
-        301,
-        303,
-        405,
-        139,
-        140,
-        141,
-        142,
-        143,
-        144,
-        145,
-        146,
-        149,
+from django.db import transaction
+from django.utils import timezone
+
+from apps.domdata.models import CatalogVersion, ImportSource, Nation, Unit
+from apps.domdata.signals import catalog_signals_disconnected
+
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+LEADER_TYPES_FILES = [
+    "csvs/coast_leader_types_by_nation.csv",
+    "csvs/fort_leader_types_by_nation.csv",
+    "csvs/nonfort_leader_types_by_nation.csv",
+]
+TROOP_TYPES_FILES = [
+    "csvs/coast_troop_types_by_nation.csv",
+    "csvs/fort_troop_types_by_nation.csv",
+    "csvs/nonfort_troop_types_by_nation.csv",
+]
+SPECIAL_TROOP_FILE = "csvs/attributes_by_nation.csv"
+CSV_FILES = [
+    "csvs/BaseU.csv",
+    "csvs/nations.csv",
+    *LEADER_TYPES_FILES,
+    *TROOP_TYPES_FILES,
+    SPECIAL_TROOP_FILE,
+]
+# some magic numbers, that I've gotten from searching source of the modinspector
+COMMANDER_ATTRIBUTES_NUMBERS = [
+    158,
+    159,
+    163,
+    186,
+    295,
+    297,
+    299,
+    301,
+    303,
+    405,
+    139,
+    140,
+    141,
+    142,
+    143,
+    144,
+    145,
+    146,
+    149,
+]
+BATCH_SIZE = 500
+
+
+@contextmanager
+def phase(timings, name):
+    """Append ``(name, seconds)`` to ``timings`` once the block is done."""
+    start = time.perf_counter()
+    yield
+    timings.append((name, time.perf_counter() - start))
+
+
+def read_csv(filename):
+    with open(os.path.join(CURRENT_DIR, filename), "r", newline="") as csv_file:
+        yield from csv.DictReader(csv_file, delimiter="\t")
+
+
+def batched(items, size):
+    for start in range(0, len(items), size):
+        end = start + size
+        yield items[start:end]
+
+
+UnitFields = namedtuple("UnitFields", ["name", "commander", "modded"])
+NationFields = namedtuple("NationFields", ["name", "era", "modded"])
+
+
+def get_dm_files():
+    return [
+        os.path.relpath(path, CURRENT_DIR)
+        for path in sorted(glob.glob(os.path.join(CURRENT_DIR, "mods/*.dm")))
     ]
-    with open(
-        os.path.join(current_dir, special_troop_file), "r", newline=""
-    ) as csv_file:
-        reader = csv.DictReader(csv_file, delimiter="\t")
-        for row in reader:
-            nation = Nation.objects.get(dominion_id=row["nation_number"])
-            unit = Unit.objects.filter(dominion_id=row["raw_value"]).first()
-            if unit:
-                if int(row["attribute"]) in commander_attributes_numbers:
-                    unit.commander = True
-                    unit.save(update_fields=["commander"])
-                unit.nations.add(nation)
-
-
-def parse_dm_files():
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    files_to_parse = glob.glob(os.path.join(current_dir, "mods/*.dm"))
-    for dmfile in files_to_parse:
-        with open(dmfile, "r") as file_content:
+
+
+def get_mod(path):
+    return Unit.DE if "DomEnhanced" in os.path.basename(path) else Unit.DEBUG
+
+
+def get_sources():
+    return CSV_FILES + get_dm_files()
+
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(os.path.join(CURRENT_DIR, filename), "rb") as source:
+        for chunk in iter(lambda: source.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+MonsterRecord = namedtuple("MonsterRecord", ["dominion_id", "name"])
+NationRecord = namedtuple("NationRecord", ["dominion_id", "name", "era"])
+
+
+def tokenize_dm(lines):
+    """Yield a ``MonsterRecord`` or ``NationRecord`` for every complete block.
+
+    Only ``#newmonster`` and ``#selectnation`` blocks ending with ``#end`` and
+    having a ``#name`` are reported; comment lines starting with ``--`` are
+    skipped. Lines are consumed one at a time, so ``lines`` can be an open file.
+    """
+    new_nation, new_monster = False, False
+    monster_id, monster_name = "", ""
+    nation_id, nation_name, nation_era = "", "", ""
+    for line in lines:
+        if line.startswith("--"):
+            continue
+        if "#newmonster" in line:
+            new_nation, new_monster = False, True
+            nation_id, nation_name, nation_era = "", "", ""
+            monster_id = re.findall(r"\d+", line)[0]
+        elif "#selectnation" in line:
+            new_nation, new_monster = True, False
+            monster_id, monster_name = "", ""
+            nation_id = re.findall(r"\d+", line)[0]
+        elif "#end" in line:
+            if new_monster and monster_name:
+                yield MonsterRecord(int(monster_id), monster_name)
+            elif new_nation and nation_name:
+                era = nation_era.strip()
+                yield NationRecord(
+                    int(nation_id), nation_name, int(era) if era else None
+                )
             new_nation, new_monster = False, False
             monster_id, monster_name = "", ""
             nation_id, nation_name, nation_era = "", "", ""
-            mod = Unit.DE if "DomEnhanced" in dmfile else Unit.DEBUG
-            for line in file_content.readlines():
-                if not line.startswith("--"):
-                    if "#newmonster" in line:
-                        new_nation, new_monster = False, True
-                        nation_id, nation_name, nation_era = "", "", ""
-                        monster_id = re.findall(r"\d+", line)[0]
-                    elif "#selectnation" in line:
-                        new_nation, new_monster = True, False
-                        monster_id, monster_name = "", ""
-                        nation_id = re.findall(r"\d+", line)[0]
-                    elif "#end" in line:
-                        if new_monster and monster_name:
-                            Unit.objects.update_or_create(
-                                dominion_id=monster_id,
-                                defaults=dict(name=monster_name, modded=mod),
-                            )
-                        elif new_nation and nation_name:
-                            Nation.objects.update_or_create(
-                                dominion_id=nation_id,
-                                defaults=dict(
-                                    name=nation_name, era=nation_era, modded=mod
-                                ),
-                            )
-                        new_nation, new_monster = False, False
-                        monster_id, monster_name = "", ""
-                        nation_id, nation_name, nation_era = "", "", ""
-                    if new_monster or new_nation:
-                        if "#name" in line and "nametype" not in line:
-                            name = (
-                                " ".join(line.split(" ")[1:]).replace('"', "").strip()
-                            )
-                            if new_monster:
-                                monster_name = name
-                            elif new_nation:
-                                nation_name = name
-                        elif new_nation and "#era" in line:
-                            nation_era = " ".join(line.split(" ")[1:]).replace('"', "")
+        if new_monster or new_nation:
+            if "#name" in line and "nametype" not in line:
+                name = " ".join(line.split(" ")[1:]).replace('"', "").strip()
+                if new_monster:
+                    monster_name = name
+                elif new_nation:
+                    nation_name = name
+            elif new_nation and "#era" in line:
+                nation_era = " ".join(line.split(" ")[1:]).replace('"', "")
+
+
+def read_dm_file(filename):
+    with open(os.path.join(CURRENT_DIR, filename), "r") as file_content:
+        yield from tokenize_dm(file_content)
+
+
+def read_mod(filename):
+    return list(read_dm_file(filename))
+
+
+def read_mods(filenames, workers=None):
+    """Parse mod files into lists of records, one file per worker process.
+
+    Results come back in the order of ``filenames`` whatever the order the
+    workers finish in. No more processes than files are started, one per CPU
+    by default. A single file, or ``workers=1``, is parsed in process.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(filenames))
+    if workers < 2:
+        return [read_mod(filename) for filename in filenames]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_mod, filenames))
+
+
+class CatalogData:
+    """Wanted content of the Unit, Nation and unit-nation tables.
+
+    ``units`` and ``nations`` map dominion_ids to field values, ``relations``
+    holds ``(unit dominion_id, nation dominion_id)`` pairs and ``rows`` counts
+    the rows read from every source. Mods are applied on top of the csv dumps
+    in order of precedence, the sorted mod file names, so a later mod wins
+    when mods define the same dominion_id.
+    """
+
+    def __init__(self):
+        self.units, self.nations, self.relations, self.rows = {}, {}, set(), {}
+
+    def read_csv(self, filename):
+        self.rows[filename] = 0
+        for row in read_csv(filename):
+            self.rows[filename] += 1
+            yield row
+
+    def relate(self, unit_id, nation_id):
+        """Relate a unit to a nation if both exist and return whether they do."""
+        unit_id, nation_id = int(unit_id), int(nation_id)
+        if unit_id in self.units and nation_id in self.nations:
+            self.relations.add((unit_id, nation_id))
+            return True
+        return False
+
+    def set_commander(self, unit_id):
+        unit_id = int(unit_id)
+        self.units[unit_id] = self.units[unit_id]._replace(commander=True)
+
+    def load_csvs(self):
+        """Read units, nations and their relations from the csv dumps.
+
+        Rows of the relation files pointing to unknown units or nations are
+        skipped.
+        """
+        for row in self.read_csv("csvs/BaseU.csv"):
+            self.units[int(row["id"])] = UnitFields(row["name"], False, Unit.VANILLA)
+        for row in self.read_csv("csvs/nations.csv"):
+            self.nations[int(row["id"])] = NationFields(
+                row["name"], int(row["era"]), Nation.VANILLA
+            )
+        for filename in LEADER_TYPES_FILES:
+            for row in self.read_csv(filename):
+                if self.relate(row["monster_number"], row["nation_number"]):
+                    self.set_commander(row["monster_number"])
+        for filename in TROOP_TYPES_FILES:
+            for row in self.read_csv(filename):
+                self.relate(row["monster_number"], row["nation_number"])
+        for row in self.read_csv(SPECIAL_TROOP_FILE):
+            if (
+                self.relate(row["raw_value"], row["nation_number"])
+                and int(row["attribute"]) in COMMANDER_ATTRIBUTES_NUMBERS
+            ):
+                self.set_commander(row["raw_value"])
+
+    def apply_mod(self, filename, records):
+        """Rename and flag the units and nations of a mod, adding new ones.
+
+        A nation without ``#era`` keeps its era, or is skipped if it is new.
+        """
+        mod, count = get_mod(filename), 0
+        for record in records:
+            count += 1
+            if isinstance(record, MonsterRecord):
+                current = self.units.get(record.dominion_id)
+                commander = current.commander if current else False
+                self.units[record.dominion_id] = UnitFields(record.name, commander, mod)
+                continue
+            current = self.nations.get(record.dominion_id)
+            era = record.era or (current.era if current else None)
+            if era:
+                self.nations[record.dominion_id] = NationFields(record.name, era, mod)
+        self.rows[filename] = count
+
+
+def sync_rows(model, fields, wanted):
+    """Make a table match ``wanted`` by writing only the rows that differ.
+
+    ``wanted`` maps dominion_ids to tuples of values of ``fields``.
+
+    Stale rows are deleted with their unit-nation relations, a few statements
+    per batch when the catalog signals are disconnected like ``import_data``
+    does.
+
+    Returns the numbers of created, updated and deleted rows.
+    """
+    current = {
+        dominion_id: (pk, values)
+        for dominion_id, pk, *values in model.objects.values_list(
+            "dominion_id", "pk", *fields
+        )
+    }
+    stale = sorted(set(current) - set(wanted))
+    for batch in batched([current[x][0] for x in stale], BATCH_SIZE):
+        model.objects.filter(pk__in=batch).delete()
+    now, created, updated = timezone.now(), [], []
+    for dominion_id, values in wanted.items():
+        if dominion_id not in current:
+            created.append(model(dominion_id=dominion_id, **values._asdict()))
+        elif tuple(current[dominion_id][1]) != values:
+            pk = current[dominion_id][0]
+            updated.append(
+                model(pk=pk, dominion_id=dominion_id, updated=now, **values._asdict())
+            )
+    model.objects.bulk_update(updated, [*fields, "updated"], batch_size=BATCH_SIZE)
+    model.objects.bulk_create(created, batch_size=BATCH_SIZE)
+    return len(created), len(updated), len(stale)
+
+
+def sync_relations(relations):
+    """Make the unit-nation table match ``relations``, like ``sync_rows``."""
+    through = Unit.nations.through
+    unit_pks = dict(Unit.objects.values_list("dominion_id", "pk"))
+    nation_pks = dict(Nation.objects.values_list("dominion_id", "pk"))
+    wanted = {(unit_pks[unit], nation_pks[nation]) for unit, nation in relations}
+    current = {
+        (unit_pk, nation_pk): pk
+        for pk, unit_pk, nation_pk in through.objects.values_list(
+            "pk", "unit_id", "nation_id"
+        )
+    }
+    stale = sorted(pk for key, pk in current.items() if key not in wanted)
+    for batch in batched(stale, BATCH_SIZE):
+        through.objects.filter(pk__in=batch).delete()
+    created = sorted(wanted.difference(current))
+    through.objects.bulk_create(
+        (
+            through(unit_id=unit_pk, nation_id=nation_pk)
+            for unit_pk, nation_pk in created
+        ),
+        batch_size=BATCH_SIZE,
+    )
+    return len(created), 0, len(stale)
+
+
+def import_data(timings=None, force=False, workers=None):
+    """Bring the tables up to date with the csv dumps and mod files.
+
+    Sources are compared by sha256 with the ``ImportSource`` manifest and
+    nothing is done when none of them changed, unless ``force`` is set.
+    Otherwise the wanted state is read from every source, mod files being
+    parsed in up to ``workers`` processes, because mods override the dumps
+    and each other, but only the rows that differ from the
+    tables are written. They are written in one transaction which also bumps
+    the ``CatalogVersion``, so readers switch from the old data to the new one
+    at once and never see a half-imported catalog. The catalog signals are
+    disconnected meanwhile, they would bump the version on every change.
+
+    Returns the imported sources, empty if the import was skipped, and a dict
+    of ``(created, updated, deleted)`` counts per table.
+    """
+    timings = [] if timings is None else timings
+    with phase(timings, "hash"):
+        hashes = {filename: file_hash(filename) for filename in get_sources()}
+        manifest = dict(ImportSource.objects.values_list("path", "sha256"))
+    changed = [x for x in hashes if manifest.get(x) != hashes[x]]
+    removed = sorted(set(manifest) - set(hashes))
+    if not (force or changed or removed):
+        return [], {}
+    imported = list(hashes) if force else changed
+    data = CatalogData()
+    with phase(timings, "csvs"):
+        data.load_csvs()
+    with phase(timings, "mods"):
+        filenames = get_dm_files()
+        for filename, records in zip(filenames, read_mods(filenames, workers)):
+            data.apply_mod(filename, records)
+    with transaction.atomic(), catalog_signals_disconnected():
+        with phase(timings, "write"):
+            diffs = {
+                "nations": sync_rows(Nation, NationFields._fields, data.nations),
+                "units": sync_rows(Unit, UnitFields._fields, data.units),
+                "unit nations": sync_relations(data.relations),
+            }
+            ImportSource.objects.filter(path__in=removed).delete()
+            now = timezone.now()
+            for filename in imported:
+                ImportSource.objects.update_or_create(
+                    path=filename,
+                    defaults=dict(
+                        sha256=hashes[filename],
+                        rows=data.rows[filename],
+                        imported_at=now,
+                    ),
+                )
+            CatalogVersion.bump()
+    return imported, diffs
@@ -0,0 +1,285 @@
+"""In-memory search indexes over catalog entries.
+
+``NgramIndex`` answers autocomplete queries without scanning every name: all
+1-, 2- and 3-grams of lowercased names and dominion_ids are mapped to compact
+posting arrays, candidates are the intersection of the postings of a term's
+grams and only those candidates are checked and ranked. ``FuzzyIndex`` adds
+typo tolerance on top of it with a symmetric-delete index over name words.
+
+``rank`` returns every match as :class:`RankedResults`, which only ranks as
+many entries as a slice from the start needs, so a page of a broad query
+costs a top-k selection while its length is still the true number of matches.
+"""
+import heapq
+import re
+from array import array
+from collections.abc import Sequence
+
+EXACT, PREFIX, WORD, SUBSTRING = range(4)
+GRAM_SIZE = 3
+WORD_SPLIT = re.compile(r"[\W_]+")
+
+
+def grams(text):
+    """Return every distinct substring of ``text`` of 1 to GRAM_SIZE characters."""
+    found = set()
+    for end in range(1, len(text) + 1):
+        for start in range(max(0, end - GRAM_SIZE), end):
+            found.add(text[start:end])
+    return found
+
+
+def build_postings(texts):
+    postings = {}
+    for position, text in enumerate(texts):
+        for gram in grams(text):
+            postings.setdefault(gram, array("I")).append(position)
+    return postings
+
+
+def word_start(term):
+    return re.compile(r"(?<!\w)" + re.escape(term))
+
+
+def rank(texts, term, term_start):
+    """Return the best rank of ``term`` in any of ``texts``, or ``None``."""
+    ranks = []
+    for text in texts:
+        if text == term:
+            ranks.append(EXACT)
+        elif text.startswith(term):
+            ranks.append(PREFIX)
+        elif term_start.search(text):
+            ranks.append(WORD)
+        elif term in text:
+            ranks.append(SUBSTRING)
+    return min(ranks) if ranks else None
+
+
+class RankedResults(Sequence):
+    """Entries at ``positions`` of ``entries``, ranked on demand.
+
+    ``groups`` are ``(positions, key)`` pairs, every group ranked by its key
+    and coming after the previous ones.
+    """
+
+    def __init__(self, entries, groups=()):
+        self.entries = entries
+        self.groups = [(x, y) for x, y in groups if x]
+
+    def __len__(self):
+        return sum(len(x) for x, _ in self.groups)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            found = list(self)[index:] if index < 0 else self[index:][:1]
+            if not found:
+                raise IndexError(index)
+            return found[0]
+        start, stop, step = index.indices(len(self))
+        found = []
+        for positions, key in self.groups:
+            if len(found) >= stop:
+                break
+            found += heapq.nsmallest(stop - len(found), positions, key=key)
+        return [self.entries[x] for x in found[start:stop:step]]
+
+    def __iter__(self):
+        for positions, key in self.groups:
+            for position in sorted(positions, key=key):
+                yield self.entries[position]
+
+
+class NgramIndex:
+    """Rank entries by exact match, then prefix, word boundary and substring.
+
+    Entries need ``name`` and ``dominion_id`` attributes. Every search term has
+    to be found in the name or the dominion_id of an entry, like the terms of
+    DRF's ``SearchFilter``. Ties are broken by name length and entry order.
+    """
+
+    def __init__(self, entries):
+        self.entries = tuple(entries)
+        self.names = tuple(entry.name.lower() for entry in self.entries)
+        self.ids = tuple(str(entry.dominion_id) for entry in self.entries)
+        self.name_postings = build_postings(self.names)
+        self.id_postings = build_postings(self.ids)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _lookup(postings, term):
+        if len(term) <= GRAM_SIZE:
+            return set(postings.get(term, ()))
+        term_grams = sorted(
+            (gram for gram in grams(term) if len(gram) == GRAM_SIZE),
+            key=lambda gram: len(postings.get(gram, ())),
+        )
+        candidates = set(postings.get(term_grams[0], ()))
+        for gram in term_grams[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(postings.get(gram, ()))
+        return candidates
+
+    def candidates(self, term):
+        names = {
+            x for x in self._lookup(self.name_postings, term) if term in self.names[x]
+        }
+        ids = {x for x in self._lookup(self.id_postings, term) if term in self.ids[x]}
+        return names | ids
+
+    def search(self, query, limit):
+        return self.rank(query)[:limit]
+
+    def rank(self, query):
+        """Return the entries matching every term of ``query`` as ``RankedResults``."""
+        terms = query.lower().replace(",", " ").split()
+        if not terms:
+            return RankedResults(self.entries, [(range(len(self.entries)), None)])
+        candidates = None
+        for term in sorted(terms, key=len, reverse=True):
+            found = self.candidates(term)
+            candidates = found if candidates is None else candidates & found
+            if not candidates:
+                return RankedResults(self.entries)
+        phrase = " ".join(terms)
+        phrase_start = word_start(phrase)
+        term_starts = [(term, word_start(term)) for term in terms]
+
+        def score(position):
+            texts = (self.names[position], self.ids[position])
+            best = rank(texts, phrase, phrase_start)
+            if best is None:
+                # Terms found apart rank after any match of the whole phrase.
+                best = (
+                    SUBSTRING
+                    + 1
+                    + max(rank(texts, term, start) for term, start in term_starts)
+                )
+            return best, len(texts[0]), position
+
+        return RankedResults(self.entries, [(candidates, score)])
+
+
+def max_distance(word):
+    return 1 if len(word) <= 4 else 2
+
+
+def deletes(word, distance):
+    """Return ``word`` and every string made by removing up to ``distance`` chars."""
+    found, current = {word}, {word}
+    for _ in range(distance):
+        current = {
+            x[:start] + x[end:]
+            for x in current
+            for start, end in zip(range(len(x)), range(1, len(x) + 1))
+        }
+        found |= current
+    return found
+
+
+def edit_distance(first, second, limit):
+    """Damerau-Levenshtein (optimal string alignment) distance, capped at limit + 1."""
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previous_row, row = None, list(range(len(second) + 1))
+    for i, first_char in enumerate(first, start=1):
+        new_row = [i] + [0] * len(second)
+        for j, second_char in enumerate(second, start=1):
+            cost = first_char != second_char
+            new_row[j] = min(row[j] + 1, new_row[j - 1] + 1, row[j - 1] + cost)
+            if (
+                previous_row is not None
+                and j > 1
+                and first_char == second[j - 2]
+                and first[i - 2] == second_char
+            ):
+                new_row[j] = min(new_row[j], previous_row[j - 2] + 1)
+        if min(new_row) > limit:
+            return limit + 1
+        previous_row, row = row, new_row
+    return min(row[-1], limit + 1)
+
+
+class FuzzyIndex:
+    """Typo tolerant search with a symmetric-delete index over name words.
+
+    Every word of every name is stored under all strings obtained by deleting
+    up to ``max_distance`` characters from its first ``PREFIX_LENGTH``
+    characters. A query word only generates its own deletes, so lookups are a
+    handful of dict hits and edit distances are computed for those candidates
+    only, never for the whole table.
+
+    Results of the exact ``NgramIndex`` come first, then entries whose words
+    are within the edit distance of every query word, by total distance.
+    """
+
+    PREFIX_LENGTH = 7
+
+    def __init__(self, exact_index):
+        self.exact_index = exact_index
+        self.entries = exact_index.entries
+        words = {}
+        for position, name in enumerate(exact_index.names):
+            for word in WORD_SPLIT.split(name):
+                if word:
+                    words.setdefault(word, array("I")).append(position)
+        self.words = words
+        self.deletes = {}
+        for word in words:
+            prefix = word[: self.PREFIX_LENGTH]
+            for variant in deletes(prefix, max_distance(word)):
+                self.deletes.setdefault(variant, []).append(word)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def matches(self, term):
+        """Return ``{position: distance}`` for entries with a word close to term."""
+        limit = max_distance(term)
+        candidates = set()
+        for variant in deletes(term[: self.PREFIX_LENGTH], limit):
+            candidates.update(self.deletes.get(variant, ()))
+        found = {}
+        for word in candidates:
+            distance = edit_distance(term, word, limit)
+            if distance > limit:
+                continue
+            for position in self.words[word]:
+                if distance < found.get(position, limit + 1):
+                    found[position] = distance
+        return found
+
+    def search(self, query, limit):
+        return self.rank(query)[:limit]
+
+    def rank(self, query):
+        """Return the exact matches, then the close ones, as ``RankedResults``."""
+        exact = self.exact_index.rank(query)
+        terms = [x for x in WORD_SPLIT.split(query.lower()) if x]
+        if not terms:
+            return exact
+        distances = None
+        for term in terms:
+            found = self.matches(term)
+            if distances is None:
+                distances = found
+            else:
+                distances = {
+                    position: distance + found[position]
+                    for position, distance in distances.items()
+                    if position in found
+                }
+            if not distances:
+                break
+        seen = set()
+        for positions, _ in exact.groups:
+            seen.update(positions)
+        fuzzy = [x for x in distances if x not in seen]
+        names = self.exact_index.names
+        return RankedResults(
+            self.entries,
+            exact.groups + [(fuzzy, lambda x: (distances[x], len(names[x]), x))],
+        )
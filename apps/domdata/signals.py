@@ -0,0 +1,74 @@
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from apps.domdata.catalog import invalidate_catalog
+from apps.domdata.models import CatalogVersion, Nation, Unit
+
+CATALOG_SIGNALS = (
+    (post_save, Nation),
+    (post_save, Unit),
+    (post_delete, Nation),
+    (post_delete, Unit),
+    (m2m_changed, Unit.nations.through),
+)
+
+_pending = threading.local()
+
+
+def catalog_data_changed(sender, **kwargs):
+    """Drop this worker's catalog and tell the others once the change is committed."""
+    if not kwargs.get("action", "post_").startswith("post_"):
+        return
+    invalidate_catalog()
+    schedule_bump()
+
+
+def connect_catalog_signals():
+    for signal, sender in CATALOG_SIGNALS:
+        signal.connect(catalog_data_changed, sender=sender)
+
+
+def disconnect_catalog_signals():
+    for signal, sender in CATALOG_SIGNALS:
+        signal.disconnect(catalog_data_changed, sender=sender)
+
+
+@contextmanager
+def catalog_signals_disconnected():
+    """Run a block without the catalog receivers, for writers bumping the version.
+
+    Without receivers Django deletes fast again, in a statement per batch.
+    """
+    disconnect_catalog_signals()
+    try:
+        yield
+    finally:
+        connect_catalog_signals()
+
+
+def schedule_bump():
+    """Bump the catalog version on commit, once per transaction.
+
+    Every change registers a callback, but the callbacks registered until a
+    commit share a flag and only the first of them bumps.
+    """
+    flag = getattr(_pending, "flag", None)
+    if flag is None:
+        flag = _pending.flag = {"bumped": False}
+    transaction.on_commit(partial(bump_once, flag))
+
+
+def bump_once(flag):
+    if flag["bumped"]:
+        return
+    flag["bumped"] = True
+    if getattr(_pending, "flag", None) is flag:
+        _pending.flag = None
+    CatalogVersion.bump()
+
+
+connect_catalog_signals()
@@ -0,0 +1,290 @@
+"""Columnar store of the numeric unit stats of ``BaseU.csv``.
+
+The importer only keeps ids and names of units; the few hundred stat columns
+are loaded here once per worker, one ``array`` of 32-bit integers per column
+with a row per unit. Range filters are answered by bisecting a sorted copy of
+the column and orderings sort row positions by a column, so queries never
+touch the columns they do not use.
+
+Most units of ``BaseU.csv`` do not have a gold cost of their own: a
+``basecost`` around 10000 is an offset from a cost the game computes from the
+other stats. Their ``gcost`` is unknown, ``None`` in rows, left out of
+selections and sorted last, instead of passing the offset for a cost.
+``gcost_estimate`` is known for every unit: the ``gcost`` when there is one,
+else an approximation of the game's cost, see :func:`estimate_gold_cost`.
+Army suggestions and summaries, which need a cost for every unit, use it.
+"""
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import repeat
+from operator import mul
+
+from apps.domdata.parser import read_csv
+
+STATS_FILE = "csvs/BaseU.csv"
+# Columns of BaseU.csv which are not integers.
+TEXT_COLUMNS = ("name", "gemprod", "incunrest", "fixedname")
+# Costs within GOLD_COST_OFFSETS of 10000 are offsets from the cost computed by the
+# game, like 10045 for 45 more or 9990 for 10 less.
+GOLD_COST_BASE = 10000
+GOLD_COST_OFFSETS = 1000
+# The game adds leadership and magic to the offsets, approximated with these prices.
+TROOP_LEADERSHIP = 40
+LEADERSHIP_GOLD = 0.5
+MAGIC_LEVEL_GOLD = 30
+MAGIC_PATHS = ("F", "A", "W", "E", "S", "D", "N", "B", "H")
+# Random paths as (chance, number of picks, levels per pick) columns.
+RANDOM_PATHS = tuple(
+    ("rand{}".format(x), "nbr{}".format(x), "link{}".format(x)) for x in range(1, 5)
+)
+OPERATORS = ("exact", "gt", "gte", "lt", "lte")
+DEFAULT_STATS = (
+    "gcost",
+    "gcost_estimate",
+    "basecost",
+    "rcost",
+    "hp",
+    "prot",
+    "mr",
+    "att",
+    "def",
+    "leader",
+)
+ARMY_STATS = ("gcost_estimate", "rcost", "hp")
+
+
+def gold_cost(basecost):
+    """Return the gold cost of a ``basecost``, ``None`` if the game computes it."""
+    if abs(basecost - GOLD_COST_BASE) < GOLD_COST_OFFSETS:
+        return None
+    return basecost
+
+
+def estimate_gold_cost(basecost, leader=0, magic_levels=0):
+    """Return the gold cost of a ``basecost``, approximated if the game computes it.
+
+    The offset is charged ``LEADERSHIP_GOLD`` per point of leadership above
+    ``TROOP_LEADERSHIP`` and ``MAGIC_LEVEL_GOLD`` per magic level, at least 1.
+    """
+    cost = gold_cost(basecost)
+    if cost is not None:
+        return cost
+    return max(
+        1,
+        basecost
+        - GOLD_COST_BASE
+        + int(max(0, leader - TROOP_LEADERSHIP) * LEADERSHIP_GOLD)
+        + round(magic_levels * MAGIC_LEVEL_GOLD),
+    )
+
+
+def get_magic_levels(row):
+    """Return the magic levels of a ``BaseU.csv`` row, random paths by their chance."""
+    levels = sum(int(row.get(x) or 0) for x in MAGIC_PATHS)
+    for chance, picks, link in RANDOM_PATHS:
+        levels += (
+            int(row.get(chance) or 0)
+            / 100
+            * int(row.get(picks) or 0)
+            * int(row.get(link) or 0)
+        )
+    return levels
+
+
+class StatTable:
+    """Integer stat columns indexed by dominion_id.
+
+    Missing values are 0. ``unknown`` maps column names to the positions whose
+    value is not known, stored as 0. ``gcost`` and ``gcost_estimate`` are
+    derived from ``basecost``, see :func:`gold_cost` and :func:`estimate_gold_cost`.
+    """
+
+    def __init__(self, ids, columns, unknown=None):
+        self.ids = array("i", ids)
+        self.positions = {dominion_id: x for x, dominion_id in enumerate(self.ids)}
+        self.columns = columns
+        self.unknown = unknown or {}
+        self._sorted = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, dominion_id):
+        return dominion_id in self.positions
+
+    @classmethod
+    def from_csv(cls, filename=STATS_FILE):
+        rows = list(read_csv(filename))
+        names = [x for x in rows[0] if x not in TEXT_COLUMNS] if rows else []
+        columns = {
+            name: array("i", [int(row[name] or 0) for row in rows]) for name in names
+        }
+        gold = [gold_cost(x) for x in columns.get("basecost", ())]
+        columns["gcost"] = array("i", [x or 0 for x in gold])
+        unknown = {"gcost": frozenset(x for x, y in enumerate(gold) if y is None)}
+        columns["gcost_estimate"] = array(
+            "i",
+            [
+                estimate_gold_cost(
+                    int(row["basecost"] or 0),
+                    int(row["leader"] or 0),
+                    get_magic_levels(row),
+                )
+                for row in rows
+            ],
+        )
+        return cls(columns.pop("id", ()), columns, unknown)
+
+    def is_known(self, name, position):
+        return position not in self.unknown.get(name, ())
+
+    def get_column(self, name):
+        return self.columns[name]
+
+    def get_row(self, dominion_id, names):
+        """Return ``{name: value}`` for a unit, ``None`` for unknown units.
+
+        Unknown values are ``None``.
+        """
+        position = self.positions.get(dominion_id)
+        if position is None:
+            return None
+        return {
+            name: self.get_column(name)[position]
+            if self.is_known(name, position)
+            else None
+            for name in names
+        }
+
+    def _sorted_column(self, name):
+        """Return the sorted known values of a column and their positions."""
+        found = self._sorted.get(name)
+        if found is None:
+            column, unknown = self.get_column(name), self.unknown.get(name, ())
+            order = sorted(
+                (x for x in range(len(column)) if x not in unknown),
+                key=column.__getitem__,
+            )
+            found = (array("i", map(column.__getitem__, order)), array("i", order))
+            with self._lock:
+                found = self._sorted.setdefault(name, found)
+        return found
+
+    def select(self, name, operator, value):
+        """Return the positions of the rows whose ``name`` compares to ``value``."""
+        values, order = self._sorted_column(name)
+        start, end = 0, len(values)
+        if operator in ("exact", "gte"):
+            start = bisect_left(values, value)
+        elif operator == "gt":
+            start = bisect_right(values, value)
+        if operator in ("exact", "lte"):
+            end = bisect_right(values, value)
+        elif operator == "lt":
+            end = bisect_left(values, value)
+        elif operator not in OPERATORS:
+            raise ValueError("Unknown operator {}".format(operator))
+        return order[start:end]
+
+    def query(self, filters=(), ordering=None, dominion_ids=None):
+        """Return the dominion_ids of units matching all ``filters``.
+
+        ``filters`` are ``(name, operator, value)`` triples, ``ordering`` a
+        column name, prefixed with ``-`` for a descending order, and
+        ``dominion_ids`` restricts the units searched. Ties keep file order,
+        units whose ordering value is unknown come last.
+        """
+        selections = [self.select(*x) for x in filters]
+        if dominion_ids is not None:
+            selections.append(
+                [self.positions[x] for x in dominion_ids if x in self.positions]
+            )
+        selections.sort(key=len)
+        if selections:
+            positions = set(selections[0])
+            for selected in selections[1:]:
+                if not positions:
+                    break
+                positions.intersection_update(selected)
+        else:
+            positions = range(len(self.ids))
+        positions = sorted(positions)
+        if ordering:
+            name = ordering.lstrip("-")
+            column, unknown = self.get_column(name), self.unknown.get(name, ())
+            known = [x for x in positions if x not in unknown]
+            known.sort(key=column.__getitem__, reverse=ordering.startswith("-"))
+            positions = known + [x for x in positions if x in unknown]
+        return [self.ids[x] for x in positions]
+
+    def weighted_sums(self, dominion_ids, weights, names):
+        """Return ``{name: sum(stat * weight)}`` over the given units.
+
+        Every unit must be in the table. Columns are read at the positions of
+        all units at once instead of looking up units one by one.
+        """
+        positions = array("i", map(self.positions.__getitem__, dominion_ids))
+        weights = array("i", weights)
+        return {
+            name: sum(
+                map(mul, map(self.get_column(name).__getitem__, positions), weights)
+            )
+            for name in names
+        }
+
+    def summarize_army(self, commanders, units):
+        """Return the costs, hit points and leadership of an army.
+
+        ``commanders`` are dominion_ids and ``units`` ``(dominion_id,
+        quantity)`` pairs; units without stats only count in ``units`` and
+        are listed in ``missing_stats``. ``gold`` counts the ``gcost_estimate``
+        of units whose gold cost is unknown, they are listed in
+        ``estimated_gold`` and ``gold_is_estimate`` is then true.
+        """
+        quantities = [int(quantity) for _, quantity in units]
+        known_units = [
+            (dominion_id, quantity)
+            for (dominion_id, _), quantity in zip(units, quantities)
+            if dominion_id in self.positions
+        ]
+        known_commanders = [x for x in commanders if x in self.positions]
+        leaders = self.weighted_sums(
+            known_commanders, repeat(1, len(known_commanders)), ARMY_STATS + ("leader",)
+        )
+        troops = self.weighted_sums(
+            [x for x, _ in known_units], [x for _, x in known_units], ARMY_STATS
+        )
+        missing = {x for x in commanders if x not in self.positions}
+        missing.update(x for x, _ in units if x not in self.positions)
+        estimated = {
+            x
+            for x in known_commanders + [x for x, _ in known_units]
+            if not self.is_known("gcost", self.positions[x])
+        }
+        return {
+            "commanders": len(commanders),
+            "units": sum(quantities),
+            "gold": leaders["gcost_estimate"] + troops["gcost_estimate"],
+            "gold_is_estimate": bool(estimated),
+            "resources": leaders["rcost"] + troops["rcost"],
+            "hp": leaders["hp"] + troops["hp"],
+            "leadership_used": sum(quantities),
+            "leadership_available": leaders["leader"],
+            "missing_stats": sorted(missing),
+            "estimated_gold": sorted(estimated),
+        }
+
+
+_table = None
+_lock = threading.Lock()
+
+
+def get_stat_table():
+    global _table
+    if _table is None:
+        with _lock:
+            if _table is None:
+                _table = StatTable.from_csv()
+    return _table
@@ -0,0 +1,483 @@
+import math
+import random
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+from django.db import transaction
+
+import pytest
+
+from apps.core.factories import NationFactory, UnitFactory
+from apps.domdata import catalog as catalog_module
+from apps.domdata.armies import Candidate, build_army
+from apps.domdata.catalog import (
+    Catalog,
+    UnitEntry,
+    get_catalog,
+    invalidate_catalog,
+    parse_mods,
+)
+from apps.domdata.models import CatalogVersion, ImportSource, Nation, Unit
+from apps.domdata.modindex import (
+    MONSTER,
+    NATION,
+    build_offsets,
+    find_definition,
+    get_mod_index,
+    parse_block,
+)
+from apps.domdata.parser import (
+    BATCH_SIZE,
+    CatalogData,
+    MonsterRecord,
+    NationFields,
+    NationRecord,
+    UnitFields,
+    get_dm_files,
+    get_sources,
+    import_data,
+    read_mods,
+    sync_rows,
+    tokenize_dm,
+)
+from apps.domdata.search import FuzzyIndex, NgramIndex, edit_distance
+from apps.domdata.signals import catalog_signals_disconnected
+from apps.domdata.stats import (
+    StatTable,
+    estimate_gold_cost,
+    get_stat_table,
+    gold_cost,
+)
+
+pytestmark = pytest.mark.django_db()
+
+
+@pytest.fixture
+def catalog_data():
+    ulm = NationFactory(era=Nation.EARLY, name="Ulm", dominion_id=11)
+    pythium = NationFactory(
+        era=Nation.MIDDLE, name="Pythium", dominion_id=44, modded=Nation.DE
+    )
+    commander = UnitFactory(
+        dominion_id=100, name="Ulm Commander", commander=True, nation_set=[]
+    )
+    commander.nations.set([ulm])
+    troop = UnitFactory(
+        dominion_id=200, name="Hoplite", commander=False, modded=Unit.DE, nation_set=[]
+    )
+    troop.nations.set([ulm, pythium])
+    return ulm, pythium, commander, troop
+
+
+def test_catalog_indexes(catalog_data, django_assert_num_queries):
+    ulm, pythium, commander, troop = catalog_data
+    # The version and the three tables, in a savepoint of the test transaction.
+    with django_assert_num_queries(6):
+        catalog = get_catalog()
+    assert catalog.nations[11].name == "Ulm"
+    assert catalog.nations[44].get_era_display() == "MA"
+    assert catalog.find_nation(Nation.EARLY, "Ulm") == catalog.nations[11]
+    assert catalog.find_nation(Nation.MIDDLE, "Pythium", Nation.DE).dominion_id == 44
+    assert catalog.find_nation(Nation.MIDDLE, "Pythium", Nation.VANILLA) is None
+    assert catalog.units[100].commander
+    assert catalog.units[200].nations == (11, 44)
+    assert [x.dominion_id for x in catalog.get_units((Unit.DE,))] == [200]
+    assert [x.dominion_id for x in catalog.get_nations((1, 2))] == [11, 44]
+    with pytest.raises(TypeError):
+        catalog.units[300] = None
+
+
+def test_catalog_is_reused_until_data_changes(catalog_data, django_assert_num_queries):
+    catalog = get_catalog()
+    with django_assert_num_queries(0):
+        assert get_catalog() is catalog
+    UnitFactory(dominion_id=300, nation_set=[])
+    assert 300 in get_catalog().units
+
+
+def test_catalog_rebuilds_after_version_bump(catalog_data, settings):
+    settings.CATALOG_CHECK_INTERVAL = 0
+    settings.CATALOG_BACKGROUND_REBUILD = False
+    catalog = get_catalog()
+    assert get_catalog() is catalog
+    CatalogVersion.bump()
+    rebuilt = get_catalog()
+    assert rebuilt is not catalog
+    assert rebuilt.version == catalog.version + 1
+
+
+def test_catalog_rebuilds_in_background(catalog_data, settings):
+    settings.CATALOG_CHECK_INTERVAL = 0
+    catalog = get_catalog()
+    CatalogVersion.bump()
+    with mock.patch.object(catalog_module.threading, "Thread") as thread:
+        assert get_catalog() is catalog
+        assert get_catalog() is catalog
+    thread.assert_called_once_with(
+        target=catalog_module.rebuild_catalog, args=(catalog.version + 1,), daemon=True
+    )
+    with mock.patch.object(catalog_module, "connections"):
+        catalog_module.rebuild_catalog(catalog.version + 1)
+    assert get_catalog().version == catalog.version + 1
+
+
+def test_catalog_preload_closes_connections(catalog_data):
+    invalidate_catalog()
+    with mock.patch.object(catalog_module, "connections") as connections:
+        assert isinstance(catalog_module.preload_catalog(), Catalog)
+        connections.close_all.assert_called_once_with()
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (None, (1,)),
+        ("", (1,)),
+        ("2,1,2", (1, 2)),
+        ("x,3", (3,)),
+        ("1,999", (1,)),
+        ("100000", (1,)),
+    ],
+)
+def test_parse_mods(value, expected):
+    assert parse_mods(value) == expected
+
+
+@pytest.fixture
+def search_entries():
+    return [
+        UnitEntry(1, "Heavy Hoplite", False, 1, ()),
+        UnitEntry(2, "Hoplite", False, 1, ()),
+        UnitEntry(3, "Black Hoplite", False, 1, ()),
+        UnitEntry(4, "Chophoplite", False, 1, ()),
+        UnitEntry(12, "Myrmidon", False, 1, ()),
+        UnitEntry(120, "Hoplite Commander", True, 1, ()),
+    ]
+
+
+def test_ngram_index_ranking(search_entries):
+    index = NgramIndex(search_entries)
+    found = [x.dominion_id for x in index.search("hoplite", 10)]
+    assert found == [2, 120, 1, 3, 4]
+    assert [x.dominion_id for x in index.search("HOP", 2)] == [2, 120]
+    assert [x.dominion_id for x in index.search("my", 10)] == [12]
+    assert index.search("phalanx", 10) == []
+
+
+def test_ngram_index_ranked_results(search_entries):
+    index = NgramIndex(search_entries)
+    ranked = index.rank("hoplite")
+    assert len(ranked) == 5
+    assert [x.dominion_id for x in ranked] == [2, 120, 1, 3, 4]
+    assert [x.dominion_id for x in ranked[1:3]] == [120, 1]
+    assert ranked[4].dominion_id == ranked[-1].dominion_id == 4
+    assert ranked[5:] == []
+    assert len(index.rank("")) == len(search_entries)
+    assert len(FuzzyIndex(index).rank("hopilte")) == 4
+
+
+def test_ngram_index_dominion_ids_and_terms(search_entries):
+    index = NgramIndex(search_entries)
+    assert [x.dominion_id for x in index.search("12", 10)] == [12, 120]
+    assert [x.dominion_id for x in index.search("hoplite commander", 10)] == [120]
+    assert [x.dominion_id for x in index.search("commander hop", 10)] == [120]
+    assert [x.dominion_id for x in index.search("", 2)] == [1, 2]
+
+
+def test_catalog_search_index_per_mod_set(catalog_data):
+    catalog = get_catalog()
+    vanilla = catalog.get_search_index("units", (Unit.VANILLA,))
+    assert catalog.get_search_index("units", (Unit.VANILLA,)) is vanilla
+    assert [x.dominion_id for x in vanilla.search("hoplite", 10)] == []
+    both = catalog.get_search_index("units", (Unit.VANILLA, Unit.DE))
+    assert [x.dominion_id for x in both.search("hoplite", 10)] == [200]
+    nations = catalog.get_search_index("nations", (Nation.DE,))
+    assert [x.dominion_id for x in nations.search("pyth", 10)] == [44]
+
+
+def test_fuzzy_index(search_entries):
+    index = FuzzyIndex(NgramIndex(search_entries))
+    assert [x.dominion_id for x in index.search("hoplit", 3)] == [2, 120, 1]
+    assert [x.dominion_id for x in index.search("hopilte", 10)] == [2, 1, 3, 120]
+    assert [x.dominion_id for x in index.search("mirmidon", 10)] == [12]
+    assert [x.dominion_id for x in index.search("hopilte comander", 10)] == [120]
+    assert index.search("phalanx", 10) == []
+
+
+@pytest.mark.parametrize(
+    "first,second,expected",
+    [("hoplite", "hoplite", 0), ("hopilte", "hoplite", 1), ("hoplit", "hoplite", 1)],
+)
+def test_edit_distance(first, second, expected):
+    assert edit_distance(first, second, 2) == expected
+    assert edit_distance("myrmidon", "hoplite", 2) == 3
+
+
+def test_import_data(django_assert_max_num_queries, django_assert_num_queries):
+    UnitFactory(dominion_id=99999, nation_set=[])
+    with django_assert_max_num_queries(120):
+        imported, diffs = import_data()
+    assert imported == get_sources()
+    assert diffs["units"] == (5400, 0, 1)
+    assert not Unit.objects.filter(dominion_id=99999).exists()
+    assert Nation.objects.get(dominion_id=5).name == "Arcoscephale"
+    commander = Unit.objects.get(dominion_id=431)
+    assert commander.commander
+    assert commander.nations.filter(dominion_id=5).exists()
+    assert not Unit.objects.get(dominion_id=1).commander
+    assert Unit.nations.through.objects.count() == 3250
+    assert ImportSource.objects.get(path="csvs/BaseU.csv").rows == 3469
+
+    assert CatalogVersion.get_current() == 1
+    with django_assert_num_queries(1):
+        assert import_data() == ([], {})
+    assert CatalogVersion.get_current() == 1
+
+
+def test_import_data_writes_differences_only():
+    import_data()
+    unit = Unit.objects.get(dominion_id=431)
+    Unit.objects.filter(dominion_id=431).update(name="Renamed")
+    unit.nations.clear()
+    ImportSource.objects.filter(path="mods/DomEnhanced1_77.dm").update(sha256="")
+    imported, diffs = import_data()
+    assert imported == ["mods/DomEnhanced1_77.dm"]
+    assert diffs == {
+        "nations": (0, 0, 0),
+        "units": (0, 1, 0),
+        "unit nations": (unit.nations.count(), 0, 0),
+    }
+    assert Unit.objects.get(dominion_id=431).name == unit.name
+
+
+def test_sync_rows_deletes_stale_rows_at_once(django_assert_num_queries):
+    nation = NationFactory()
+    units = UnitFactory.create_batch(BATCH_SIZE + 100, nation_set=[nation])
+    kept = units[0]
+    wanted = {kept.dominion_id: UnitFields(kept.name, kept.commander, kept.modded)}
+    # Reading the table, then per batch the units, their relations and the units,
+    # with the savepoint and release of the delete.
+    with catalog_signals_disconnected(), django_assert_num_queries(1 + 2 * 5):
+        assert sync_rows(Unit, UnitFields._fields, wanted) == (0, 0, BATCH_SIZE + 99)
+    assert list(Unit.objects.all()) == [kept]
+    assert Unit.nations.through.objects.get().unit_id == kept.pk
+
+
+@pytest.mark.django_db(transaction=True)
+def test_catalog_signals_bump_once_per_transaction():
+    with mock.patch.object(CatalogVersion, "bump") as bump:
+        with transaction.atomic():
+            UnitFactory.create_batch(3)
+            NationFactory().delete()
+        assert bump.call_count == 1
+        with transaction.atomic():
+            UnitFactory()
+        assert bump.call_count == 2
+        with catalog_signals_disconnected():
+            UnitFactory()
+        assert bump.call_count == 2
+
+
+DM_TEXT = """#newmonster 5000
+#name "Sea Hoplite"
+#end
+--#newmonster 5001
+#newmonster 5002
+#nametype 100
+#end
+#selectnation 120
+#name "Atlantis"
+#era 2
+#end
+#newmonster 14
+#name "Hoplite of Doom"
+#end
+"""
+
+
+def test_tokenize_dm():
+    assert list(tokenize_dm(iter(DM_TEXT.splitlines(True)))) == [
+        MonsterRecord(5000, "Sea Hoplite"),
+        NationRecord(120, "Atlantis", 2),
+        MonsterRecord(14, "Hoplite of Doom"),
+    ]
+
+
+def test_catalog_data_apply_mod():
+    data = CatalogData()
+    data.units[14] = UnitFields("Hoplite", True, Unit.VANILLA)
+    data.nations[120] = NationFields("Atlantis", Nation.LATE, Nation.VANILLA)
+    records = list(tokenize_dm(DM_TEXT.splitlines(True)))
+    records.append(NationRecord(121, "Eraless", None))
+    data.apply_mod("mods/DomEnhanced1_77.dm", records)
+    assert data.rows["mods/DomEnhanced1_77.dm"] == 4
+    assert data.units == {
+        14: ("Hoplite of Doom", True, Unit.DE),
+        5000: ("Sea Hoplite", False, Unit.DE),
+    }
+    assert data.nations == {120: ("Atlantis", Nation.MIDDLE, Nation.DE)}
+
+
+def test_read_mods_in_processes():
+    filenames = get_dm_files()
+    parsed = read_mods(filenames, workers=2)
+    assert parsed == read_mods(filenames, workers=1)
+    assert [len(x) for x in parsed] == [1, 1955]
+    with mock.patch(
+        "apps.domdata.parser.ProcessPoolExecutor", wraps=ProcessPoolExecutor
+    ) as pool:
+        assert read_mods(filenames, workers=16) == parsed
+    pool.assert_called_once_with(max_workers=len(filenames))
+
+
+def test_build_offsets():
+    data = DM_TEXT.encode()
+    offsets = build_offsets(data.splitlines(True))
+    assert sorted(offsets) == [
+        (MONSTER, 14),
+        (MONSTER, 5000),
+        (MONSTER, 5002),
+        (NATION, 120),
+    ]
+    start, length = offsets[(NATION, 120)]
+    end = start + length
+    assert data[start:end] == b'#selectnation 120\n#name "Atlantis"\n#era 2\n#end\n'
+
+
+def test_mod_index_definitions():
+    index = get_mod_index("mods/DomEnhanced1_77.dm")
+    assert index is get_mod_index("mods/DomEnhanced1_77.dm")
+    definition = index.get_definition(MONSTER, 6550)
+    assert definition[:3] == (
+        ("#newmonster", "6550"),
+        ("#name", "Ghulam"),
+        ("#spr1", "Juhera/mamluk_militia1.tga"),
+    )
+    assert ("#weapon", "spear") in definition
+    assert definition[-1] == ("#end", "")
+    assert index.get_definition(MONSTER, 6550) is definition
+    assert find_definition(MONSTER, 6550, Unit.DE) is definition
+    assert find_definition(MONSTER, 6550, Unit.DEBUG) is None
+    with mock.patch("apps.domdata.modindex.get_dm_files") as get_dm_files:
+        assert find_definition(MONSTER, 6550, Unit.DE) is definition
+    assert not get_dm_files.called
+    with pytest.raises(KeyError):
+        index.get_definition(MONSTER, 1)
+
+
+def test_mod_index_multiline_values():
+    definition = dict(find_definition(NATION, 130, Unit.DE))
+    assert definition["#name"] == "Bhöd"
+    descr = definition["#descr"]
+    assert descr.startswith("The Kingdom of Bhöd is a cold, mountainous land")
+    assert descr.endswith("the Bhödpa, Mi Gö and Lha spirits act as one.")
+    assert "\nThe religion of Bhöd teaches deference" in descr
+    assert definition["#summary"].count("\n") == 3
+    assert parse_block('#descr "Two\n#lines" -- note\n#hp 10\n') == (
+        ("#descr", "Two\n#lines"),
+        ("#hp", "10"),
+    )
+
+
+@pytest.mark.parametrize(
+    "filters,ordering,expected",
+    [
+        ((), None, [7, 8, 9, 10]),
+        ((("hp", "gte", 10),), None, [8, 9, 10]),
+        ((("hp", "gt", 10), ("leader", "exact", 40)), None, [9]),
+        ((("hp", "lt", 20),), "-gcost", [10, 7, 8]),
+        ((("leader", "lte", 0),), None, []),
+    ],
+)
+def test_stat_table_query(filters, ordering, expected):
+    table = StatTable(
+        [7, 8, 9, 10],
+        {
+            "hp": array("i", [5, 10, 20, 10]),
+            "leader": array("i", [10, 10, 40, 80]),
+            "gcost": array("i", [9, 9, 100, 15]),
+        },
+    )
+    assert table.query(filters, ordering) == expected
+    assert table.query(filters, ordering, [8, 10, 11]) == [
+        x for x in expected if x in (8, 10)
+    ]
+
+
+def test_stat_table_from_csv():
+    table = get_stat_table()
+    assert len(table) == 3469
+    assert table.get_row(5, ["basecost", "gcost", "leader"]) == {
+        "basecost": 10045,
+        "gcost": None,
+        "leader": 60,
+    }
+    assert table.get_row(216, ["gcost"]) == {"gcost": 260}
+    assert table.get_row(4, ["gcost"]) == {"gcost": 0}
+    assert table.get_row(999999, ["gcost"]) is None
+    assert 5 not in table.query([("gcost", "gte", 0)])
+    ordered = table.query(ordering="-gcost")
+    assert ordered.index(216) < ordered.index(5)
+    assert gold_cost(30) == 30
+    assert gold_cost(10045) is None
+    assert gold_cost(9990) is None
+    assert table.get_row(5, ["gcost_estimate"]) == {"gcost_estimate": 45 + 10}
+    assert table.get_row(216, ["gcost_estimate"]) == {"gcost_estimate": 260}
+    # Adept of the Silver Order: A2 S2 and a random path.
+    assert table.get_row(100, ["gcost_estimate"]) == {"gcost_estimate": 10 + 5 * 30}
+    assert estimate_gold_cost(30, 120, 3) == 30
+    assert estimate_gold_cost(10020, 120, 1) == 20 + 40 + 30
+    assert estimate_gold_cost(9990) == 1
+
+
+def test_stat_table_summarize_army():
+    table = StatTable(
+        [7, 8, 9],
+        {
+            "gcost": array("i", [10, 0, 100]),
+            "gcost_estimate": array("i", [10, 25, 100]),
+            "rcost": array("i", [1, 2, 30]),
+            "hp": array("i", [10, 12, 20]),
+            "leader": array("i", [10, 40, 80]),
+        },
+        {"gcost": frozenset([1])},
+    )
+    summary = table.summarize_army([9, 10], [(7, "5"), (8, 2), (11, 3)])
+    assert summary == {
+        "commanders": 2,
+        "units": 10,
+        "gold": 100 + 10 * 5 + 25 * 2,
+        "gold_is_estimate": True,
+        "resources": 30 + 1 * 5 + 2 * 2,
+        "hp": 20 + 10 * 5 + 12 * 2,
+        "leadership_used": 10,
+        "leadership_available": 80,
+        "missing_stats": [10, 11],
+        "estimated_gold": [8],
+    }
+
+
+def test_army_search():
+    commanders = [
+        Candidate(1, "Captain", 30, 1, 10, 40),
+        Candidate(2, "Lord", 100, 1, 15, 120),
+    ]
+    troops = [
+        Candidate(3, "Militia", 7, 1, 10, 0),
+        Candidate(4, "Knight", 40, 20, 20, 0),
+    ]
+    army = build_army(commanders, troops, 400, 200, random.Random(1), 20000)
+    assert 390 <= army.gold <= 400
+    assert army.resources <= 200
+    assert army.commanders
+    assert sum(x for _, x in army.troops) <= army.leadership
+    army = build_army(commanders, troops, 400, math.inf, random.Random(1), 0)
+    assert 300 <= army.gold <= 400
+    assert army.commanders and army.troops
+    # The commander share does not leave room for the Lord.
+    assert (
+        commanders[0]
+        == build_army(commanders, [], 100, 200, random.Random(1), 0).commanders[0][0]
+    )
+    assert build_army(commanders, troops, 20, 200, random.Random(1), 0).gold == 0
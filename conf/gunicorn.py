@@ -0,0 +1,37 @@
+"""
+Gunicorn config for project.
+
+The application is loaded in the master process, which runs the warmup of
+``apps.core.warmup`` once, then forked into workers sharing its memory. If that
+warmup failed, every worker runs it again after the fork.
+"""
+import gc
+import os
+
+bind = "{}:{}".format(os.environ.get("HOST", "0.0.0.0"), os.environ.get("PORT", "8000"))
+preload_app = True
+errorlog = "-"
+capture_output = True
+
+
+def when_ready(server):
+    # Move everything loaded so far out of the collector's generations: collections
+    # in the workers would otherwise write to, and so copy, the shared pages.
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from django.db import DatabaseError, connection
+
+    from apps.core.warmup import is_ready, warmup
+
+    if not is_ready():
+        warmup()
+    # Open the persistent DB connection of the worker before its first request.
+    try:
+        connection.ensure_connection()
+    except DatabaseError:
+        server.log.warning(
+            "Worker %s started without a database connection", worker.pid
+        )
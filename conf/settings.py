@@ -152,6 +152,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "apps.core.metrics.ServerTimingMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
@@ -191,6 +192,16 @@ if SENTRY_DSN:
 
 DATABASE_URL = env.str("DATABASE_URL", default="No")
 DATABASES = {"default": env.db("DATABASE_URL")}
+# Keep connections open between requests, workers connect once after the fork.
+DATABASES["default"]["CONN_MAX_AGE"] = env.int("CONN_MAX_AGE", default=60)
+
+########################################################################################
+#                                                                                      #
+#                                           Caching                                    #
+#                                                                                      #
+########################################################################################
+
+CACHES = {"default": env.cache("CACHE_URL", default="locmemcache://")}
 
 ########################################################################################
 #                                                                                      #
@@ -231,7 +242,10 @@ CORS_ALLOW_HEADERS = default_headers + (
 
 CORS_EXPOSE_HEADERS = (
     "ETag",
+    "Link",
+    "X-Total-Count",
     "Last-Modified",
+    "Server-Timing",
     "HTTP_X_RESPONSE_ID",
     "HTTP_GIT_BRANCH",
     "Access-Control-Expose-Headers",
@@ -388,3 +402,34 @@ if ENV == "test":
 #                                           App specific                               #
 #                                                                                      #
 ########################################################################################
+
+# Rendered maps are cached per worker up to MAP_CACHE_MAX_BYTES. Set MAP_CACHE_ALIAS to
+# one of the CACHES to share them between workers as well.
+MAP_CACHE_MAX_BYTES = env.int("MAP_CACHE_MAX_BYTES", default=32 * 1024 * 1024)
+MAP_CACHE_ALIAS = env.str("MAP_CACHE_ALIAS", default="")
+MAP_CACHE_TIMEOUT = env.int("MAP_CACHE_TIMEOUT", default=60 * 60 * 24)
+
+# Workers check whether the Nation/Unit catalog was re-imported at most this often.
+CATALOG_CHECK_INTERVAL = env.float("CATALOG_CHECK_INTERVAL", default=10.0)
+# Rebuild a re-imported catalog in a background thread, serving the old one meanwhile.
+CATALOG_BACKGROUND_REBUILD = env.bool("CATALOG_BACKGROUND_REBUILD", default=True)
+
+# Autocomplete searches without ?limit return pages of this many best ranked entries.
+AUTOCOMPLETE_SEARCH_LIMIT = env.int("AUTOCOMPLETE_SEARCH_LIMIT", default=50)
+
+# Autocomplete lists are paginated with ?limit/?offset and never return more than this.
+AUTOCOMPLETE_MAX_LIMIT = env.int("AUTOCOMPLETE_MAX_LIMIT", default=1000)
+
+# Nation rosters only change with the data import, clients may keep them this long.
+ROSTER_CACHE_MAX_AGE = env.int("ROSTER_CACHE_MAX_AGE", default=60 * 60)
+
+# Army suggestions try at most this many moves per army, the same on every worker.
+ARMY_SUGGESTION_ITERATIONS = env.int("ARMY_SUGGESTION_ITERATIONS", default=20000)
+
+# Check the query count of views declaring a query budget. Requests over budget are
+# logged, or fail with QUERY_BUDGET_RAISE, which the tests use.
+QUERY_BUDGETS = env.bool("QUERY_BUDGETS", default=ENV == "test")
+QUERY_BUDGET_RAISE = env.bool("QUERY_BUDGET_RAISE", default=ENV == "test")
+
+if QUERY_BUDGETS:
+    MIDDLEWARE = MIDDLEWARE + ["apps.core.querybudget.QueryBudgetMiddleware"]
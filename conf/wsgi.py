@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "conf.settings")
 
 application = get_wsgi_application()
+
+# With ``gunicorn --preload`` this runs once in the master process, so the workers
+# share the catalog, templates and stats copy-on-write instead of each loading them.
+# A failure is logged and retried in the workers, it does not stop the server.
+from apps.core.warmup import warmup  # noqa: E402 isort:skip
+
+warmup()
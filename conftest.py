@@ -1,12 +1,20 @@
 """ This file contains global level fixtures for the pytest
 """
+import json
 import os
+import platform
 import shutil
+import statistics
+import subprocess
+import time
 
 from django.conf import settings
 
 import pytest
 
+from apps.domdata.armies import clear_suggestions
+from apps.domdata.catalog import invalidate_catalog
+
 
 @pytest.fixture(scope="session", autouse=True)
 def remove_tempdir(request):
@@ -18,3 +26,89 @@ def remove_tempdir(request):
             shutil.rmtree(settings.MEDIA_ROOT)
 
     request.addfinalizer(fin)
+
+
+@pytest.fixture(autouse=True)
+def fresh_catalog():
+    """ Every test starts without a cached Nation/Unit catalog or army suggestions,
+    test data changes without bumping the catalog version
+    """
+    invalidate_catalog()
+    clear_suggestions()
+    yield
+    invalidate_catalog()
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        help="Run the tests marked as benchmark, skipped otherwise",
+    )
+    parser.addoption(
+        "--benchmark-json",
+        default="benchmark.json",
+        help="File the benchmark results are written to",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmarks only run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+def pytest_sessionfinish(session):
+    results = getattr(session.config, "benchmark_results", None)
+    if not results:
+        return
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    with open(session.config.getoption("--benchmark-json"), "w") as output:
+        json.dump(
+            {
+                "commit": commit,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "benchmarks": results,
+            },
+            output,
+            indent=2,
+            sort_keys=True,
+        )
+
+
+@pytest.fixture
+def benchmark(request):
+    """ Time a callable, results are written as JSON at the end of the session
+
+    ``benchmark(name, func, *args, rounds=5, setup=None)`` runs ``setup`` then
+    ``func`` ``rounds`` times and returns the last result of ``func``.
+    """
+    results = request.config.__dict__.setdefault("benchmark_results", {})
+
+    def run(name, func, *args, rounds=5, setup=None, **kwargs):
+        timings = []
+        for _ in range(rounds):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            timings.append(time.perf_counter() - start)
+        results["{}::{}".format(request.node.name, name)] = {
+            "rounds": rounds,
+            "min": min(timings),
+            "median": statistics.median(timings),
+            "mean": statistics.mean(timings),
+            "max": max(timings),
+        }
+        return result
+
+    return run
@@ -1,4 +1,3 @@
-import axios from 'axios';
 import 'bootstrap/dist/css/bootstrap.min.css';
 import {
   Container, Row, Col, Button,
@@ -7,7 +6,8 @@ import React, { useState, useEffect } from 'react';
 import PropTypes from 'prop-types';
 import Step1 from './Step1';
 import Step2 from './Step2';
-import Mods from './consts';
+import Mods, { NATIONS_LIMIT } from './consts';
+import { fetchSuggestions, generateMap } from './utils';
 
 const NextStepButton1 = ({ setCurrentStep }) => (
   <Row>
@@ -63,9 +63,7 @@ FinalMapComponent.propTypes = {
 
 function App() {
   const [nations, setNations] = useState([]);
-  const [units, setUnits] = useState([]);
   const [isLoadingNations, setLoadingNations] = useState(false);
-  const [isLoadingUnits, setLoadingUnits] = useState(false);
   const [finalMapData, setfinalMapData] = useState('');
   const [currentStep, setCurrentStep] = useState('step1');
   const [nationForStep2, setNationForStep2] = useState('');
@@ -81,19 +79,11 @@ function App() {
 
   useEffect(() => {
     setLoadingNations(true);
-    setLoadingUnits(true);
-    axios.get(`/api/v0/autocomplete/units/?modded=${selectedMods.join(',')}`)
-      .then((response) => {
-        setLoadingUnits(false);
-        setUnits(response.data);
-      }).catch((error) => {
-        console.log('Error', error);
-        return [];
-      });
-    axios.get(`/api/v0/autocomplete/nations/?modded=${selectedMods.join(',')}`)
-      .then((response) => {
+    // Units are searched as they are typed, see UnitSuggestions.
+    fetchSuggestions('nations', selectedMods, '', NATIONS_LIMIT)
+      .then((results) => {
         setLoadingNations(false);
-        setNations(response.data);
+        setNations(results);
       }).catch((error) => {
         console.log('Error', error);
         return [];
@@ -123,10 +113,10 @@ function App() {
       use_cave_map: selectedCaveMap,
     };
     setLoadingNations(true);
-    axios.post('/api/v0/generate-map/', objectToPost)
-      .then((response) => {
+    generateMap(objectToPost)
+      .then((finalMap) => {
         setLoadingNations(false);
-        setfinalMapData(response.data);
+        setfinalMapData(finalMap);
         setCurrentStep('final');
       }).catch((error) => {
         console.log('Error', error);
@@ -166,8 +156,6 @@ function App() {
       {currentStep === 'step2' && (
         <>
           <Step2
-            units={units}
-            isLoading={isLoadingUnits}
             selectedNation={nationForStep2}
             selectCommander={addCommander}
             selectedCommanders={selectedCommanders}
@@ -175,8 +163,7 @@ function App() {
             selectUnit={addUnit}
             selectedMods={selectedMods}
           />
-          {showNextNation && !isLoadingUnits
-          && (
+          {showNextNation && (
           <NextNationButton
             setNationIndex={setNationIndex}
             nationIndex={nationIndex}
@@ -9,8 +9,6 @@ import UnitRow from './UnitRow';
 import uuidv4 from './utils';
 
 const Step2 = ({
-  units,
-  isLoading,
   selectedNation,
   selectCommander,
   selectedCommanders,
@@ -138,29 +136,23 @@ const Step2 = ({
       <Row>
         <Col>
           <p>Select commanders</p>
-          {isLoading ? 'loading' : (
-            <UnitSuggestions
-              id="commander"
-              units={units}
-              selectUnit={selectCommander}
-              selectedUnits={selectedCommanders}
-              selectedNation={selectedNation}
-              selectedMods={selectedMods}
-            />
-          )}
+          <UnitSuggestions
+            id="commander"
+            selectUnit={selectCommander}
+            selectedUnits={selectedCommanders}
+            selectedNation={selectedNation}
+            selectedMods={selectedMods}
+          />
         </Col>
         <Col>
           <p>Select units to add to the commanders</p>
-          {isLoading ? 'loading' : (
-            <UnitSuggestions
-              id="unit"
-              units={units}
-              selectUnit={selectUnit}
-              selectedUnits={selectedUnits}
-              selectedNation={selectedNation}
-              selectedMods={selectedMods}
-            />
-          )}
+          <UnitSuggestions
+            id="unit"
+            selectUnit={selectUnit}
+            selectedUnits={selectedUnits}
+            selectedNation={selectedNation}
+            selectedMods={selectedMods}
+          />
         </Col>
       </Row>
     </>
@@ -168,8 +160,6 @@ const Step2 = ({
 };
 
 Step2.propTypes = {
-  units: PropTypes.arrayOf(PropTypes.object).isRequired,
-  isLoading: PropTypes.bool.isRequired,
   selectedNation: PropTypes.string.isRequired,
   selectCommander: PropTypes.func.isRequired,
   selectedCommanders: PropTypes.arrayOf(PropTypes.object).isRequired,
@@ -2,18 +2,8 @@ import 'bootstrap/dist/css/bootstrap.min.css';
 import React from 'react';
 import Autosuggest from 'react-autosuggest';
 import PropTypes from 'prop-types';
-import uuidv4 from './utils';
-
-function escapeRegexCharacters(str) {
-  return str.replace(/[.*+?^${}()|[\]\\]/g, '\\$&');
-}
-
-const getUnitSuggestions = (value, units) => {
-  const escapedValue = escapeRegexCharacters(value.trim());
-  const regex = new RegExp(`^${escapedValue}`, 'i');
-
-  return units.filter((unit) => regex.test(unit.name) || regex.test(unit.dominion_id));
-};
+import uuidv4, { fetchSuggestions } from './utils';
+import { UNITS_LIMIT } from './consts';
 
 const getUnitSuggestionValue = (suggestion) => `${suggestion.dominion_id}/${suggestion.name}`;
 
@@ -59,14 +49,24 @@ class UnitSuggestions extends React.Component {
     }
 
     onSuggestionsFetchRequested = ({ value }) => {
-      const { units } = this.props;
-      const suggestions = getUnitSuggestions(value, units).slice(0, 100);
-      this.setState({
-        suggestions,
-      });
+      const { selectedMods } = this.props;
+      const search = value.trim();
+      this.lastSearch = search;
+      fetchSuggestions('units', selectedMods, search, UNITS_LIMIT)
+        .then((suggestions) => {
+          // Answers to earlier keystrokes may arrive after the latest one.
+          if (search === this.lastSearch) {
+            this.setState({
+              suggestions,
+            });
+          }
+        }).catch((error) => {
+          console.log('Error', error);
+        });
     };
 
     onSuggestionsClearRequested = () => {
+      this.lastSearch = null;
       this.setState({
         suggestions: [],
       });
@@ -101,10 +101,10 @@ class UnitSuggestions extends React.Component {
 }
 
 UnitSuggestions.propTypes = {
-  units: PropTypes.arrayOf(PropTypes.object).isRequired,
   selectUnit: PropTypes.func.isRequired,
   selectedUnits: PropTypes.arrayOf(PropTypes.object).isRequired,
   selectedNation: PropTypes.string.isRequired,
+  selectedMods: PropTypes.arrayOf(PropTypes.number).isRequired,
 };
 
 export default UnitSuggestions;
@@ -5,3 +5,8 @@ const Mods = {
 };
 
 export default Mods;
+
+// Every nation of a mod set fits in one page of the autocomplete.
+export const NATIONS_LIMIT = 1000;
+// Units are searched on the server, a page per typed value.
+export const UNITS_LIMIT = 100;
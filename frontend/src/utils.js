@@ -1,4 +1,5 @@
 /* eslint-disable no-bitwise */
+import axios from 'axios';
 
 export default function uuidv4() {
   return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, (c) => {
@@ -8,3 +9,22 @@ export default function uuidv4() {
     return v.toString(16);
   });
 }
+
+// Entries of an autocomplete list, one bounded page searched on the server.
+export const fetchSuggestions = (kind, mods, search, limit) => axios.get(
+  `/api/v0/autocomplete/${kind}/`,
+  { params: { modded: mods.join(','), search, limit } },
+).then((response) => response.data);
+
+const MAP_SLOT = /\$(?:(\$)|([_a-zA-Z][_a-zA-Z0-9]*)|\{([_a-zA-Z][_a-zA-Z0-9]*)\})/g;
+
+// Fill the $name slots of a base map, like Python's string.Template.
+export const spliceMap = (base, context) => base.replace(
+  MAP_SLOT,
+  (match, escaped, named, braced) => (escaped ? '$' : String(context[named || braced])),
+);
+
+// Only the scenario is generated, the base map stays in the browser cache.
+export const generateMap = (payload) => axios.post('/api/v0/generate-map/?output=scenario', payload)
+  .then(({ data }) => axios.get(data.base, { responseType: 'text' })
+    .then((base) => spliceMap(base.data, data.context)));